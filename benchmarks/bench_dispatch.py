@@ -0,0 +1,48 @@
+# Copyright 2014-2017 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+pytest-benchmark entry point for :mod:`benchmarks.dispatch`.
+
+Usage::
+
+    python -m pytest benchmarks/bench_dispatch.py [--benchmark-json FILE]
+
+The wall time of each round covers a full sequence of hooks, and the metrics
+of each hook of the last round are recorded in the benchmark's
+``extra_info``.
+"""
+
+import pytest
+
+from benchmarks import dispatch
+
+pytest.importorskip('pytest_benchmark')
+
+
+SHAPES = {
+    'small': dict(modules=5, handlers=50, depth=3, endpoints=1, units=2, external=0),
+    'medium': dict(modules=20, handlers=200, depth=5, endpoints=3, units=5, external=0),
+    'large': dict(modules=50, handlers=1000, depth=10, endpoints=5, units=20, external=0),
+    'external': dict(modules=5, handlers=50, depth=3, endpoints=1, units=2, external=2),
+}
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_dispatch(benchmark, shape):
+    results = benchmark.pedantic(dispatch.run, kwargs=SHAPES[shape], rounds=3)
+    for metrics in results:
+        benchmark.extra_info[metrics['hook']] = metrics
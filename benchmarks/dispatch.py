@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright 2014-2017 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark a full reactive hook run (import, :func:`~charms.reactive.bus.discover`,
+and :func:`~charms.reactive.bus.dispatch`) against a synthetic charm generated
+by :mod:`benchmarks.synthetic`, using the fake hook tools and counting unit
+state database from :mod:`benchmarks.fakes`.
+
+Each hook runs in a fresh Python process, as it would under Juju, and the
+unit state persists between hooks, so the first hook shows the cold start
+and the later ones the steady state.
+
+Usage::
+
+    python -m benchmarks.dispatch [--modules N] [--handlers M] [--depth D]
+                                  [--endpoints K] [--units U] [--external E]
+                                  [--hooks HOOK[,HOOK...]] [--lazy] [--cli-server]
+
+A hook may be given as ``ENDPOINT-relation-changed`` to run it in the context
+of the endpoint's relation and its first remote unit.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import BIN_DIR
+from benchmarks.synthetic import generate_charm
+
+
+ROOT_DIR = os.path.dirname(BIN_DIR)
+
+DEFAULT_HOOKS = ['install', 'config-changed', 'bench0-relation-changed', 'update-status']
+
+COLUMNS = [
+    ('hook', '{:<28}'),
+    ('wall_ms', '{:>9.1f}'),
+    ('import_ms', '{:>9.1f}'),
+    ('discover_ms', '{:>11.1f}'),
+    ('dispatch_ms', '{:>11.1f}'),
+    ('iterations', '{:>10}'),
+    ('handler_tests', '{:>13}'),
+    ('predicate_calls', '{:>15}'),
+    ('kv_reads', '{:>8}'),
+    ('kv_writes', '{:>9}'),
+    ('kv_commits', '{:>10}'),
+    ('juju_log', '{:>8}'),
+    ('hook_tools', '{:>10}'),
+    ('subprocesses', '{:>12}'),
+]
+
+
+def _timed(metrics, name, func):
+    def _wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics[name] = metrics.get(name, 0) + (time.perf_counter() - start) * 1000
+    return _wrapper
+
+
+def run_child(output):
+    """
+    Run a single hook in this process, and write its metrics to ``output``.
+    """
+    metrics = {}
+    start = time.perf_counter()
+    import charms.reactive
+    from charmhelpers.core import hookenv
+    from benchmarks import fakes
+    metrics['import_ms'] = (time.perf_counter() - start) * 1000
+
+    fakes.install(hookenv.charm_dir())
+    bus = charms.reactive.bus
+    _discover = bus.discover
+
+    def discover():
+        _discover()
+        fakes.count_predicates()
+
+    bus.discover = _timed(metrics, 'discover_ms', discover)
+    bus.dispatch = _timed(metrics, 'dispatch_ms', bus.dispatch)
+    charms.reactive.main()
+    metrics['wall_ms'] = (time.perf_counter() - start) * 1000
+    metrics.update(fakes.counters.as_dict())
+    with open(output, 'w') as fp:
+        json.dump(metrics, fp)
+
+
+def run_hook(charm_dir, hook, relations, env=None):
+    """
+    Run a single hook against the charm in a fresh process, with any extra
+    environment variables given, and return its metrics.
+    """
+    env = dict(os.environ, **(env or {}))
+    env.update({
+        'CHARM_DIR': charm_dir,
+        'JUJU_CHARM_DIR': charm_dir,
+        'JUJU_HOOK_NAME': hook,
+        'JUJU_UNIT_NAME': 'bench/0',
+        'UNIT_STATE_DB': os.path.join(charm_dir, '.unit-state.db'),
+        'PATH': os.pathsep.join([os.path.dirname(sys.executable), BIN_DIR, env.get('PATH', '')]),
+        'PYTHONPATH': os.pathsep.join([ROOT_DIR, env.get('PYTHONPATH', '')]),
+    })
+    for var in ('JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT', 'JUJU_REMOTE_APP'):
+        env.pop(var, None)
+    endpoint_name = hook.split('-relation-')[0]
+    if endpoint_name in relations:
+        rid, units = sorted(relations[endpoint_name].items())[0]
+        env.update({
+            'JUJU_RELATION': endpoint_name,
+            'JUJU_RELATION_ID': rid,
+        })
+        if units:
+            remote_unit = sorted(units)[0]
+            env['JUJU_REMOTE_UNIT'] = remote_unit
+            env['JUJU_REMOTE_APP'] = remote_unit.split('/')[0]
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.check_call([sys.executable, '-m', 'benchmarks.dispatch', '--child', output],
+                              cwd=charm_dir, env=env, stdout=subprocess.DEVNULL)
+        with open(output) as fp:
+            metrics = json.load(fp)
+    finally:
+        os.remove(output)
+    metrics['hook'] = hook
+    return metrics
+
+
+def run(hooks=DEFAULT_HOOKS, env=None, **shape):
+    """
+    Generate a synthetic charm of the given shape (see
+    :func:`~benchmarks.synthetic.generate_charm`), run the given hooks
+    against it in order, and return the metrics for each.
+    """
+    charm_dir = tempfile.mkdtemp(prefix='bench-charm-')
+    try:
+        relations = generate_charm(charm_dir, **shape)
+        return [run_hook(charm_dir, hook, relations, env) for hook in hooks]
+    finally:
+        shutil.rmtree(charm_dir)
+
+
+def format_table(results):
+    header = []
+    for name, fmt in COLUMNS:
+        width = len(fmt.format('' if name == 'hook' else 0))
+        header.append(name.ljust(width) if name == 'hook' else name.rjust(width))
+    lines = [' '.join(header)]
+    for metrics in results:
+        lines.append(' '.join(fmt.format(metrics.get(name, 0)) for name, fmt in COLUMNS))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modules', type=int, default=10)
+    parser.add_argument('--handlers', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--endpoints', type=int, default=2)
+    parser.add_argument('--units', type=int, default=3)
+    parser.add_argument('--external', type=int, default=0)
+    parser.add_argument('--hooks', default=','.join(DEFAULT_HOOKS))
+    parser.add_argument('--lazy', action='store_true', help='Enable lazy handler module import')
+    parser.add_argument('--cli-server', action='store_true',
+                        help='Answer external handler CLI commands in the hook process')
+    parser.add_argument('--json', action='store_true', help='Output raw metrics as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child)
+
+    env = {}
+    if args.lazy:
+        env['CHARMS_REACTIVE_LAZY_IMPORT'] = 'true'
+    if args.cli_server:
+        env['CHARMS_REACTIVE_CLI_SERVER'] = 'true'
+    results = run(hooks=args.hooks.split(','),
+                  env=env,
+                  modules=args.modules,
+                  handlers=args.handlers,
+                  depth=args.depth,
+                  endpoints=args.endpoints,
+                  units=args.units,
+                  external=args.external)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_table(results))
+
+
+if __name__ == '__main__':
+    main()
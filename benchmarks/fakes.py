@@ -0,0 +1,203 @@
+# Copyright 2014-2017 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local stand-ins for the Juju hook tools and the unit state database, which
+count how often the framework touches them.
+
+Hook context (charm dir, hook name, unit, relation) is taken from the usual
+``JUJU_*`` / ``CHARM_DIR`` environment variables, as with a real hook, and
+only the functions which would run a hook tool are replaced.
+"""
+
+import collections
+import json
+import os
+import subprocess
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+from charms.reactive import bus
+from charms.reactive import trace
+
+from benchmarks.synthetic import RELATIONS_FILE
+
+
+class Counters(collections.Counter):
+    """
+    Counts of the interesting operations performed while running a hook.
+    """
+    def as_dict(self):
+        return dict(sorted(self.items()))
+
+
+counters = Counters()
+
+
+class CountingStorage(unitdata.Storage):
+    """
+    :class:`~charmhelpers.core.unitdata.Storage` which counts reads, writes,
+    flushes, and the flushes which commit a transaction.
+    """
+    def get(self, key, default=None, record=False):
+        counters['kv_reads'] += 1
+        return super(CountingStorage, self).get(key, default, record)
+
+    def getrange(self, key_prefix, strip=False):
+        counters['kv_reads'] += 1
+        return super(CountingStorage, self).getrange(key_prefix, strip)
+
+    def set(self, key, value):
+        counters['kv_writes'] += 1
+        return super(CountingStorage, self).set(key, value)
+
+    def unset(self, key):
+        counters['kv_writes'] += 1
+        return super(CountingStorage, self).unset(key)
+
+    def unsetrange(self, keys=None, prefix=""):
+        counters['kv_writes'] += 1
+        return super(CountingStorage, self).unsetrange(keys, prefix)
+
+    def flush(self, save=True):
+        counters['kv_flushes'] += 1
+        if save and self.conn.in_transaction:
+            counters['kv_commits'] += 1
+        return super(CountingStorage, self).flush(save)
+
+
+class CountingTracer(trace.LogTracer):
+    """
+    :class:`~charms.reactive.trace.LogTracer` which also counts dispatch
+    iterations and flag changes.
+    """
+    def start_dispatch_iteration(self, iteration, handlers):
+        counters['iterations'] += 1
+        super(CountingTracer, self).start_dispatch_iteration(iteration, handlers)
+
+    def set_flag(self, flag):
+        counters['flags_set'] += 1
+        super(CountingTracer, self).set_flag(flag)
+
+    def clear_flag(self, flag):
+        counters['flags_cleared'] += 1
+        super(CountingTracer, self).clear_flag(flag)
+
+
+class FakeHookTools(object):
+    """
+    Relation hook tools backed by the layout written by
+    :func:`~benchmarks.synthetic.generate_charm`.
+    """
+    def __init__(self, charm_dir):
+        with open(os.path.join(charm_dir, RELATIONS_FILE)) as fp:
+            self.relations = json.load(fp)
+        self.local = collections.defaultdict(dict)
+
+    def _tool(self, name):
+        counters['hook_tools'] += 1
+        counters['hook_tool.' + name] += 1
+
+    def relation_ids(self, reltype=None):
+        self._tool('relation-ids')
+        reltype = reltype or hookenv.relation_type()
+        return sorted(self.relations.get(reltype, {}))
+
+    def related_units(self, relid=None):
+        self._tool('relation-list')
+        relid = relid or hookenv.relation_id()
+        endpoint_name = relid.split(':')[0]
+        return sorted(self.relations.get(endpoint_name, {}).get(relid, {}))
+
+    def relation_get(self, attribute=None, unit=None, rid=None, app=None):
+        self._tool('relation-get')
+        rid = rid or hookenv.relation_id()
+        if app is not None or unit == hookenv.local_unit():
+            data = dict(self.local[(rid, app)])
+        else:
+            unit = unit or hookenv.remote_unit()
+            endpoint_name = rid.split(':')[0]
+            data = dict(self.relations.get(endpoint_name, {}).get(rid, {}).get(unit, {}))
+        if attribute is not None:
+            return data.get(attribute)
+        return data
+
+    def relation_set(self, relation_id=None, relation_settings=None, app=False, **kwargs):
+        self._tool('relation-set')
+        rid = relation_id or hookenv.relation_id()
+        data = self.local[(rid, hookenv.application_name() if app else None)]
+        data.update(relation_settings or {})
+        data.update(kwargs)
+
+    def log(self, message, level=None):
+        counters['juju_log'] += 1
+
+    def install(self):
+        hookenv.relation_ids = hookenv.cached(self.relation_ids)
+        hookenv.related_units = hookenv.cached(self.related_units)
+        hookenv.relation_get = hookenv.cached(self.relation_get)
+        hookenv.relation_set = self.relation_set
+        hookenv.log = self.log
+
+
+class CountingPopen(subprocess.Popen):
+    """
+    :class:`subprocess.Popen` which counts the processes started, e.g. for
+    external handlers.
+    """
+    def __init__(self, *args, **kwargs):
+        counters['subprocesses'] += 1
+        super(CountingPopen, self).__init__(*args, **kwargs)
+
+
+def _counting(name, func):
+    def _wrapper(*args, **kwargs):
+        counters[name] += 1
+        return func(*args, **kwargs)
+    return _wrapper
+
+
+def count_predicates():
+    """
+    Wrap the predicates of the registered handlers, so that each predicate
+    call is counted, whether it is a flag condition or arbitrary function.
+
+    Must be called after :func:`~charms.reactive.bus.discover`.
+    """
+    for handler in bus.Handler.get_handlers():
+        if isinstance(handler, bus.ExternalHandler):
+            continue
+        handler._predicates = [
+            p if isinstance(p, bus.FlagCondition) else _counting('predicate_calls', p)
+            for p in handler._predicates]
+        handler._compiled = None
+
+
+def install(charm_dir):
+    """
+    Install the fake hook tools and the counting unit state database, tracer,
+    and handler test and condition check wrappers.
+    """
+    FakeHookTools(charm_dir).install()
+    unitdata._KV = CountingStorage()
+    subprocess.Popen = CountingPopen
+    bus.Handler.test = _counting('handler_tests', bus.Handler.test)
+    bus.ExternalHandler.test = _counting('handler_tests', bus.ExternalHandler.test)
+    bus.ConditionSet.test_mask = _counting('predicate_calls', bus.ConditionSet.test_mask)
+    bus.FlagCondition.test_mask = _counting('predicate_calls', bus.FlagCondition.test_mask)
+    # registered after the module-level LogTracer, so that this one wins
+    hookenv.atstart(trace.install_tracer, CountingTracer())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright 2014-2017 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark matching a table of handler conditions against the active flags,
+using flag sets versus :class:`~charms.reactive.bus.FlagBits` bitmasks, both
+per condition and combined per handler into a
+:class:`~charms.reactive.bus.ConditionSet`.
+
+Usage::
+
+    python benchmarks/flag_matching.py [--handlers N] [--flags M]
+"""
+
+import argparse
+import random
+import timeit
+
+from charms.reactive.bus import ConditionSet
+from charms.reactive.bus import FlagBits
+from charms.reactive.bus import FlagCondition
+
+
+def make_table(num_handlers, num_flags, seed=0):
+    """
+    Generate a table of handler conditions shaped like those of a large
+    layered charm, along with a set of active flags.
+    """
+    rng = random.Random(seed)
+    flags = ['layer{}.flag{}'.format(i % 20, i) for i in range(num_flags)]
+    table = []
+    for _ in range(num_handlers):
+        conditions = [FlagCondition(FlagCondition.ALL,
+                                    rng.sample(flags, rng.randint(1, 3)))]
+        if rng.random() < 0.6:
+            conditions.append(FlagCondition(FlagCondition.NONE,
+                                            rng.sample(flags, rng.randint(1, 2))))
+        if rng.random() < 0.1:
+            conditions.append(FlagCondition(FlagCondition.ANY,
+                                            rng.sample(flags, 2)))
+        table.append(conditions)
+    active = set(rng.sample(flags, num_flags // 2))
+    return table, active
+
+
+def match_sets(table, active_flags):
+    return [i for i, conditions in enumerate(table)
+            if all(c.test(active_flags) for c in conditions)]
+
+
+def match_masks(table, active_mask):
+    return [i for i, conditions in enumerate(table)
+            if all(c.test_mask(active_mask) for c in conditions)]
+
+
+def match_compiled(table, active_mask):
+    return [i for i, conditions in enumerate(table)
+            if conditions.test_mask(active_mask)]
+
+
+def _time(func, *args, number):
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--handlers', type=int, default=1000)
+    parser.add_argument('--flags', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    table, active = make_table(args.handlers, args.flags)
+    active_mask = FlagBits.mask(active)
+    compiled = [ConditionSet(conditions) for conditions in table]
+    expected = match_sets(table, active)
+    assert match_masks(table, active_mask) == expected
+    assert match_compiled(compiled, active_mask) == expected
+
+    times = [
+        ('sets', _time(match_sets, table, active, number=args.repeat)),
+        ('bitmasks', _time(match_masks, table, active_mask, number=args.repeat)),
+        ('compiled', _time(match_compiled, compiled, active_mask, number=args.repeat)),
+    ]
+    print('{} handlers, {} flags ({} active), {} runnable'.format(
+        args.handlers, args.flags, len(active), len(expected)))
+    for name, t in times:
+        print('  {:10} {:8.1f} us per pass  ({:.2f}x)'.format(
+            name + ':', t * 1e6, times[0][1] / t))
+
+
+if __name__ == '__main__':
+    main()
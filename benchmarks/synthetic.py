@@ -0,0 +1,173 @@
+# Copyright 2014-2017 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate synthetic reactive charms of a given shape, for benchmarking.
+
+The generated charm contains:
+
+* ``modules`` reactive modules, sharing ``handlers`` Python handlers between
+  them.  The handlers form chains of length ``depth``, where each link is
+  gated on the flag set by the previous link, so that a cold dispatch needs
+  ``depth`` iterations of the main loop to settle.  Handlers left over once
+  all complete chains have been laid out are gated on the end of a chain.
+
+* ``endpoints`` endpoints of a ``bench`` interface, each with a single
+  relation to ``units`` remote units, and a handler which reads the
+  received data when the endpoint's ``changed`` flag is set.
+
+* ``external`` bash handlers, gated on the same flags as the chains.
+
+The relation layout is written to :data:`RELATIONS_FILE` in the charm
+directory, for use by the :mod:`benchmarks.fakes` hook tools.
+"""
+
+import json
+import os
+import stat
+
+
+RELATIONS_FILE = 'bench-relations.json'
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+ENDPOINT_MODULE = '''\
+from charms.reactive import Endpoint
+from charms.reactive import clear_flag
+from charms.reactive import set_flag
+from charms.reactive import when
+
+
+class BenchRequires(Endpoint):
+    @when('endpoint.{endpoint_name}.changed')
+    def changed(self):
+        for unit in self.all_joined_units:
+            unit.received['value']
+        set_flag(self.expand_name('{endpoint_name}.seen'))
+        clear_flag(self.expand_name('endpoint.{endpoint_name}.changed'))
+'''
+
+EXTERNAL_HANDLER = '''\
+#!/bin/bash
+
+. {bin_dir}/charms.reactive.sh
+
+@when '{flag}'
+@when_not 'bench.ext{index}'
+function ext{index}() {{
+    set_state 'bench.ext{index}'
+}}
+
+reactive_handler_main
+'''
+
+
+def _flag(chain, link):
+    if link == 0:
+        return 'bench.started'
+    return 'bench.c{}.{}'.format(chain, link)
+
+
+def _chain_handlers(handlers, depth):
+    """
+    Lay out ``handlers`` handlers as chains of length ``depth``, yielding
+    ``(name, when, when_not, sets)`` tuples.
+    """
+    depth = max(depth, 1)
+    chains = max(handlers // depth, 1)
+    count = 0
+    for chain in range(chains):
+        for link in range(depth):
+            if count == handlers:
+                return
+            yield ('c{}_{}'.format(chain, link),
+                   [_flag(chain, link)],
+                   [_flag(chain, link + 1)],
+                   _flag(chain, link + 1))
+            count += 1
+    while count < handlers:
+        chain = count % chains
+        yield ('extra{}'.format(count),
+               ['bench.started', _flag(chain, depth)],
+               ['bench.extra{}'.format(count)],
+               'bench.extra{}'.format(count))
+        count += 1
+
+
+def _handler_source(name, when, when_not, sets):
+    decorators = ''
+    if when:
+        decorators += '@when({})\n'.format(', '.join(repr(f) for f in when))
+    decorators += '@when_not({})\n'.format(', '.join(repr(f) for f in when_not))
+    return '\n\n{}def {}():\n    set_flag({!r})\n'.format(decorators, name, sets)
+
+
+def generate_charm(path, modules=10, handlers=100, depth=5, endpoints=2,
+                   units=3, external=0):
+    """
+    Write a synthetic charm into the (existing) directory ``path``.
+
+    :return: The relation layout, as written to :data:`RELATIONS_FILE`.
+    """
+    reactive_dir = os.path.join(path, 'reactive')
+    interface_dir = os.path.join(path, 'hooks', 'relations', 'bench')
+    os.makedirs(reactive_dir)
+    os.makedirs(interface_dir)
+
+    metadata = ['name: bench', 'summary: bench', 'description: bench']
+    if endpoints:
+        metadata.append('requires:')
+        for k in range(endpoints):
+            metadata.append('  bench{}:'.format(k))
+            metadata.append('    interface: bench')
+    with open(os.path.join(path, 'metadata.yaml'), 'w') as fp:
+        fp.write('\n'.join(metadata) + '\n')
+    with open(os.path.join(path, 'revision'), 'w') as fp:
+        fp.write('1\n')
+
+    for parent in (os.path.join(path, 'hooks', 'relations'), interface_dir):
+        open(os.path.join(parent, '__init__.py'), 'w').close()
+    with open(os.path.join(interface_dir, 'requires.py'), 'w') as fp:
+        fp.write(ENDPOINT_MODULE)
+
+    sources = [[] for _ in range(max(modules, 1))]
+    sources[0].append(_handler_source('start', [], ['bench.started'], 'bench.started'))
+    for i, handler in enumerate(_chain_handlers(handlers, depth)):
+        sources[i % len(sources)].append(_handler_source(*handler))
+    for i, source in enumerate(sources):
+        with open(os.path.join(reactive_dir, 'mod{}.py'.format(i)), 'w') as fp:
+            fp.write('from charms.reactive import set_flag, when, when_not\n')
+            fp.write(''.join(source))
+
+    chains = max(handlers // max(depth, 1), 1)
+    for e in range(external):
+        filepath = os.path.join(reactive_dir, 'ext{}.sh'.format(e))
+        with open(filepath, 'w') as fp:
+            fp.write(EXTERNAL_HANDLER.format(bin_dir=BIN_DIR, index=e,
+                                             flag=_flag(e % chains, 1)))
+        os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IXUSR)
+
+    relations = {}
+    for k in range(endpoints):
+        endpoint_name = 'bench{}'.format(k)
+        rid = '{}:{}'.format(endpoint_name, k)
+        relations[endpoint_name] = {rid: {
+            'remote{}/{}'.format(k, u): {'value': json.dumps(u)}
+            for u in range(units)
+        }}
+    with open(os.path.join(path, RELATIONS_FILE), 'w') as fp:
+        json.dump(relations, fp, indent=2, sort_keys=True)
+    return relations
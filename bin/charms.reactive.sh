@@ -70,6 +70,21 @@ if [[ "$0" == "$BASH_SOURCE" ]]; then
     exit 0
 fi
 
+if [[ -n "${CHARMS_REACTIVE_CLI_FD-}" ]]; then
+    function charms.reactive() {
+        _suppress_xtrace
+        # send the command to the dispatching hook process, which answers it
+        # over the inherited socket, rather than starting a new interpreter
+        local code output
+        printf '%s\0' "$#" "$@" >&$CHARMS_REACTIVE_CLI_FD
+        IFS= read -r -d '' code <&$CHARMS_REACTIVE_CLI_FD || code=1
+        IFS= read -r -d '' output <&$CHARMS_REACTIVE_CLI_FD
+        printf '%s' "$output"
+        _restore_xtrace
+        return $code
+    }
+fi
+
 REACTIVE_ACTION="${1-'--test'}"
 REACTIVE_ARGS="${2-}"
 
@@ -133,6 +148,14 @@ function reactive_handler_main() {
             >&2 echo "End reactive_handler_main (test)"
             exit 1
         fi
+    elif [[ "$REACTIVE_ACTION" == "--describe" ]]; then
+        # declare the handlers and their tests, one spec per line as given
+        # to `charms.reactive test`, so that the dispatcher can test them
+        # itself rather than running this file with --test
+        echo 'charms.reactive describe 1'
+        for spec in "${REACTIVE_TESTS[@]}"; do
+            echo "$spec"
+        done
     elif [[ "$REACTIVE_ACTION" == "--invoke" ]]; then
         >&2 echo "Running reactive_handler_main for $(basename $0) (invoke)"
         invoked=()
@@ -14,34 +14,137 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib
 import os
+import time
 import traceback
 
-from .flags import *  # noqa
-from .relations import *  # noqa
-from .endpoints import *  # noqa
-from .decorators import *  # noqa
-from .helpers import *  # noqa
-from .patterns.request_response import *  # noqa
-
-from . import bus
-from . import flags
-from . import helpers
-from charmhelpers.core import hookenv
-from charmhelpers.core import unitdata
-
-
-# DEPRECATED: transitional imports for backwards compatibility
-bus.StateList = flags.StateList
-bus.State = flags.State
-bus.set_state = flags.set_flag
-bus.remove_state = flags.clear_flag
-bus.get_state = flags.get_state
-bus.get_states = flags.get_states
-helpers.is_state = flags.is_flag_set
-helpers.toggle_state = flags.toggle_flag
-helpers.all_states = flags.all_flags_set
-helpers.any_states = flags.any_flags_set
+_import_started = time.perf_counter()
+
+from . import bus  # noqa: E402
+from .trace import StartupProfiler  # noqa: E402
+from charmhelpers.core import hookenv  # noqa: E402
+from charmhelpers.core import unitdata  # noqa: E402
+
+
+# Listed explicitly, so that ``from charms.reactive import *`` resolves each
+# name through __getattr__ below, rather than copying only the names loaded
+# so far.
+__all__ = [
+    'main',
+    # flags
+    'set_flag',
+    'clear_flag',
+    'toggle_flag',
+    'register_trigger',
+    'is_flag_set',
+    'all_flags_set',
+    'any_flags_set',
+    'get_flags',
+    'get_unset_flags',
+    'set_state',  # DEPRECATED
+    'remove_state',  # DEPRECATED
+    'toggle_state',  # DEPRECATED
+    'is_state',  # DEPRECATED
+    'all_states',  # DEPRECATED
+    'get_states',  # DEPRECATED
+    'any_states',  # DEPRECATED
+    # relations
+    'endpoint_from_name',
+    'endpoint_from_flag',
+    'relation_from_flag',  # DEPRECATED
+    'relation_from_state',  # DEPRECATED
+    'RelationBase',
+    'scopes',
+    # endpoints
+    'Endpoint',
+    # decorators
+    'when',
+    'when_all',
+    'when_any',
+    'when_not',
+    'when_none',
+    'when_not_all',
+    'hook',
+    'when_file_changed',
+    'not_unless',
+    'only_once',
+    'collect_metrics',
+    'meter_status_changed',
+    # helpers
+    'data_changed',
+    'is_data_changed',
+    'any_file_changed',
+    # patterns.request_response
+    'Field',
+    'BaseRequest',
+    'BaseResponse',
+    'RequesterEndpoint',
+    'ResponderEndpoint',
+    # modules
+    'bus',
+    'decorators',
+    'endpoints',
+    'flags',
+    'helpers',
+    'hookenv',
+    'patterns',
+    'relations',
+    'trace',
+    'unitdata',
+]
+
+
+# The public API is re-exported from these modules, which are only imported
+# when one of its names is first used, so that e.g. the CLI does not have to
+# import the endpoint and decorator machinery.  Later modules take
+# precedence, as with the star imports this replaces.
+_EXPORT_MODULES = (
+    '.flags',
+    '.relations',
+    '.endpoints',
+    '.decorators',
+    '.helpers',
+    '.patterns.request_response',
+)
+_exports_loaded = False
+
+
+def _load_exports():
+    global _exports_loaded
+    if _exports_loaded:
+        return
+    namespace = globals()
+    for module_name in _EXPORT_MODULES:
+        module = importlib.import_module(module_name, __name__)
+        names = getattr(module, '__all__', None)
+        if names is None:
+            names = [name for name in vars(module) if not name.startswith('_')]
+        namespace.update((name, getattr(module, name)) for name in names)
+    _exports_loaded = True
+
+
+def __getattr__(name):
+    if name.startswith('__'):
+        raise AttributeError(name)
+    try:
+        return importlib.import_module('.' + name, __name__)
+    except ModuleNotFoundError as e:
+        if e.name != '{}.{}'.format(__name__, name):
+            raise
+    _load_exports()
+    try:
+        return globals()[name]
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    _load_exports()
+    return sorted(globals())
+
+
+StartupProfiler.record('import', 'charms.reactive', time.perf_counter() - _import_started)
 
 
 def main(relation_name=None):
@@ -68,10 +171,18 @@ def main(relation_name=None):
         os.environ['JUJU_HOOK_NAME'] = hook_name
 
     try:
-        bus.discover()
+        # the exporting modules register atstart callbacks on import, which
+        # must run even if no handler imports them
+        with StartupProfiler.measure('import', 'charms.reactive.*'):
+            _load_exports()
+        with StartupProfiler.measure('discover'):
+            bus.discover()
         if not restricted_mode:  # limit what gets run in restricted mode
-            hookenv._run_atstart()
-        bus.dispatch(restricted=restricted_mode)
+            with StartupProfiler.measure('atstart'):
+                StartupProfiler.wrap_atstart()
+                hookenv._run_atstart()
+        with StartupProfiler.measure('dispatch'):
+            bus.dispatch(restricted=restricted_mode)
     except Exception:
         tb = traceback.format_exc()
         hookenv.log('Hook error:\n{}'.format(tb), level=hookenv.ERROR)
@@ -83,3 +194,4 @@ def main(relation_name=None):
     if not restricted_mode:  # limit what gets run in restricted mode
         hookenv._run_atexit()
     unitdata._KV.flush()
+    StartupProfiler.report()
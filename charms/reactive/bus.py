@@ -14,16 +14,22 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import ast
+import hashlib
 import importlib
 import os
 import sys
 import errno
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from itertools import chain
+from itertools import groupby
 from functools import partial
 
 from charmhelpers.core import hookenv
 from charmhelpers.core import unitdata
+from charms.reactive.trace import StartupProfiler
 from charms.reactive.trace import tracer
 
 
@@ -32,6 +38,27 @@ LOG_OPTS = {
     'register': 'register' in _log_opts,
 }
 
+# answer the CLI commands of external handlers in this process, see
+# :class:`~charms.reactive.cli.CLIServer`
+CLI_SERVER = os.environ.get('CHARMS_REACTIVE_CLI_SERVER') == 'true'
+
+
+def _int_env(name, default):
+    """
+    Read an integer setting from the environment, falling back to
+    ``default`` if it is unset or empty, or to 1 if it is not an integer.
+    """
+    try:
+        return int(os.environ.get(name) or default)
+    except ValueError:
+        return 1
+
+
+# number of external handler ``--test`` calls to run at once, see
+# :meth:`ExternalHandler.run_tests`; 1 runs them one by one
+TEST_WORKERS = _int_env('CHARMS_REACTIVE_TEST_WORKERS', 4)
+_stderr_lock = Lock()
+
 
 class BrokenHandlerException(Exception):
     def __init__(self, path):
@@ -68,6 +95,135 @@ def _short_action_id(action, suffix=None):
     return ':'.join(map(str, parts))
 
 
+class FlagBits(object):
+    """
+    Interns flag names as bits, so that sets of flags can be represented as
+    int bitmasks and compared using bitwise operations.
+
+    Bits are allocated in the order that flags are first seen, and are only
+    meaningful within the current process.
+    """
+    _bits = {}
+
+    @classmethod
+    def bit(cls, flag):
+        """
+        Return the bit for the given flag, allocating one if necessary.
+        """
+        bit = cls._bits.get(flag)
+        if bit is None:
+            bit = cls._bits[flag] = 1 << len(cls._bits)
+        return bit
+
+    @classmethod
+    def mask(cls, flags):
+        """
+        Return the bitmask representing the given flags.
+        """
+        mask = 0
+        for flag in flags:
+            mask |= cls.bit(flag)
+        return mask
+
+
+class FlagCondition(object):
+    """
+    Declarative condition on the set of active flags.
+
+    These are registered by the :func:`@when <charms.reactive.decorators.when>`
+    family of decorators in place of opaque predicate callbacks, so that the
+    dispatcher can inspect them and evaluate them against a single snapshot
+    of the active flags.  As with the helper predicates they replace, a
+    condition can only be satisfied during the main (``other``) phase of
+    :func:`dispatch`.
+    """
+    ALL = 'all'
+    ANY = 'any'
+    NONE = 'none'
+    NOT_ALL = 'not_all'
+
+    def __init__(self, kind, flags):
+        """
+        Create a new FlagCondition.
+
+        :param str kind: One of ``all``, ``any``, ``none``, or ``not_all``
+        :param flags: Sequence of flag names the condition applies to
+        """
+        if kind not in (self.ALL, self.ANY, self.NONE, self.NOT_ALL):
+            raise ValueError('Invalid flag condition: %s' % kind)
+        self.kind = kind
+        self.flags = tuple(flags)
+        self.mask = FlagBits.mask(self.flags)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.kind, ', '.join(self.flags))
+
+    def __eq__(self, other):
+        return (isinstance(other, FlagCondition) and
+                (self.kind, self.flags) == (other.kind, other.flags))
+
+    def __hash__(self):
+        return hash((self.kind, self.flags))
+
+    def test(self, active_flags):
+        """
+        Check this condition against the given set of active flags.
+        """
+        if self.kind == self.ALL:
+            return all(flag in active_flags for flag in self.flags)
+        if self.kind == self.ANY:
+            return any(flag in active_flags for flag in self.flags)
+        if self.kind == self.NONE:
+            return not any(flag in active_flags for flag in self.flags)
+        return not all(flag in active_flags for flag in self.flags)
+
+    def test_mask(self, active_mask):
+        """
+        Check this condition against the given :class:`FlagBits` bitmask of
+        active flags.
+        """
+        matched = active_mask & self.mask
+        if self.kind == self.ALL:
+            return matched == self.mask
+        if self.kind == self.ANY:
+            return matched != 0
+        if self.kind == self.NONE:
+            return matched == 0
+        return matched != self.mask
+
+
+class ConditionSet(object):
+    """
+    Combination of several :class:`FlagCondition` instances which are all
+    required to match, checked with a handful of bitwise operations.
+    """
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+        self.required = 0
+        self.forbidden = 0
+        self.any_masks = []
+        self.not_all_masks = []
+        for condition in self.conditions:
+            if condition.kind == FlagCondition.ALL:
+                self.required |= condition.mask
+            elif condition.kind == FlagCondition.NONE:
+                self.forbidden |= condition.mask
+            elif condition.kind == FlagCondition.ANY:
+                self.any_masks.append(condition.mask)
+            else:
+                self.not_all_masks.append(condition.mask)
+
+    def test_mask(self, active_mask):
+        """
+        Check all of the conditions against the given :class:`FlagBits`
+        bitmask of active flags.
+        """
+        return (active_mask & self.required == self.required and
+                not active_mask & self.forbidden and
+                all(active_mask & mask for mask in self.any_masks) and
+                all(active_mask & mask != mask for mask in self.not_all_masks))
+
+
 class Handler(object):
     """
     Class representing a reactive flag handler.
@@ -116,6 +272,7 @@ class Handler(object):
         self._action = action
         self._args = []
         self._predicates = []
+        self._compiled = None
         self._post_callbacks = []
         self._flags = set()
 
@@ -149,6 +306,26 @@ class Handler(object):
         if LOG_OPTS['register']:
             hookenv.log('  Adding predicate for %s: %s' % (self.id(), _predicate), level=hookenv.DEBUG)
         self._predicates.append(predicate)
+        self._compiled = None
+
+    def add_condition(self, condition):
+        """
+        Add a new :class:`FlagCondition` to this handler.
+
+        Conditions are tested in the same order as predicates, interleaved
+        with them in the order in which they were added.
+        """
+        if LOG_OPTS['register']:
+            hookenv.log('  Adding condition for %s: %r' % (self.id(), condition), level=hookenv.DEBUG)
+        self._predicates.append(condition)
+        self._compiled = None
+
+    @property
+    def conditions(self):
+        """
+        The :class:`FlagCondition` instances added to this handler.
+        """
+        return [p for p in self._predicates if isinstance(p, FlagCondition)]
 
     def add_post_callback(self, callback):
         """
@@ -162,7 +339,40 @@ class Handler(object):
         """
         if self._flags and not FlagWatch.watch(self._action_id, self._flags):
             return False
-        return all(predicate() for predicate in self._predicates)
+        leading, remaining = self._compile()
+        active_mask = None
+        if leading:
+            active_mask = _condition_mask()
+            if active_mask is False or not leading.test_mask(active_mask):
+                return False
+        for predicate in remaining:
+            if isinstance(predicate, FlagCondition):
+                if active_mask is None:
+                    active_mask = _condition_mask()
+                if active_mask is False or not predicate.test_mask(active_mask):
+                    return False
+            elif not predicate():
+                return False
+        return True
+
+    def _compile(self):
+        """
+        Split the predicates into a :class:`ConditionSet` of the conditions
+        which precede any other predicate, which can be checked all at once
+        since they have no side effects, and the remaining predicates, which
+        must be called in order.
+        """
+        if self._compiled is None:
+            num_leading = 0
+            for predicate in self._predicates:
+                if not isinstance(predicate, FlagCondition):
+                    break
+                num_leading += 1
+            leading = None
+            if num_leading:
+                leading = ConditionSet(self._predicates[:num_leading])
+            self._compiled = (leading, self._predicates[num_leading:])
+        return self._compiled
 
     def _get_args(self):
         """
@@ -199,6 +409,16 @@ class Handler(object):
         self._flags.update(flags)
 
 
+def _condition_mask():
+    """
+    Bitmask of the active flags against which to test conditions, or False
+    if conditions cannot be satisfied in the current dispatch phase.
+    """
+    if DispatchContext.phase() != 'other':
+        return False
+    return FlagCache.mask()
+
+
 class ExternalHandler(Handler):
     """
     A variant Handler for external executable actions (such as bash scripts).
@@ -217,39 +437,171 @@ class ExternalHandler(Handler):
       * When invoked with the ``--invoke`` command-line flag (which will be
         followed by any output returned by the ``--test`` call), the handler
         should perform its action(s).
+
+    Handlers using ``charms.reactive.sh`` also support the ``--describe``
+    flag, for which they output a ``charms.reactive describe 1`` line followed
+    by one line for each sub-handler, in the form given to the ``charms.reactive
+    test`` CLI command.  The description is cached in unitdata until the
+    handler file is modified, and the sub-handlers are then tested in this
+    process, so that the handler is only run to invoke them.
     """
+    DESCRIBE_HEADER = 'charms.reactive describe 1'
+    FLAG_TESTS = ('when', 'when_all', 'when_any', 'when_not', 'when_none', 'when_not_all')
+    # tests which use unitdata from the handler process, so are not run at
+    # the same time as others, see run_tests()
+    UNITDATA_TESTS = (b'when_file_changed', b'only_once')
+    describe_prefix = 'reactive.external.describe.'
+
     @classmethod
     def register(cls, filepath):
         if filepath not in Handler._HANDLERS:
             _filepath = os.path.relpath(filepath, hookenv.charm_dir())
             if LOG_OPTS['register']:
                 hookenv.log('Registering external reactive handler for %s' % _filepath, level=hookenv.DEBUG)
-            Handler._HANDLERS[filepath] = cls(filepath)
+            handler = Handler._HANDLERS[filepath] = cls(filepath)
+            handler._load_description()
         return Handler._HANDLERS[filepath]
 
     def __init__(self, filepath):
         self._filepath = filepath
         self._test_output = ''
+        self._specs = None
+        self._flags = set()
+        self._test_future = None
 
     def id(self):
         _filepath = os.path.relpath(self._filepath, hookenv.charm_dir())
         return '%s "%s"' % (_filepath, self._test_output)
 
+    def _load_description(self):
+        """
+        Load the sub-handler specs from the cached or a new ``--describe``
+        call, and register the flags they test, if each of them tests some.
+        """
+        try:
+            mtime = os.stat(self._filepath).st_mtime_ns
+        except OSError:
+            return
+        key = self.describe_prefix + os.path.relpath(self._filepath, hookenv.charm_dir())
+        cached = unitdata.kv().get(key)
+        if cached and cached['mtime'] == mtime:
+            self._specs = cached['specs']
+        else:
+            self._specs = self._describe()
+            unitdata.kv().set(key, {'mtime': mtime, 'specs': self._specs})
+        if not self._specs:
+            return
+        from charms.reactive.cli import _parse_handler_spec
+        flags = set()
+        for spec in self._specs:
+            _, _, tests = _parse_handler_spec(spec)
+            spec_flags = set(chain.from_iterable(args for test_name, args in tests
+                                                 if test_name in self.FLAG_TESTS))
+            if not spec_flags:
+                return  # this sub-handler must be tested every iteration
+            flags.update(spec_flags)
+        self.register_flags(flags)
+
+    def _describe(self):
+        """
+        Call the external handler with ``--describe``, if it uses
+        ``charms.reactive.sh``, and return its sub-handler specs, or ``None``
+        if it does not support the flag.
+        """
+        try:
+            with open(self._filepath, 'rb') as fp:
+                if b'reactive_handler_main' not in fp.read():
+                    return None
+            proc = subprocess.Popen([self._filepath, '--describe'], stdout=subprocess.PIPE, env=os.environ)
+            output, _ = proc.communicate()
+        except OSError:
+            return None
+        lines = output.decode('utf8', 'replace').splitlines()
+        if proc.returncode != 0 or not lines or lines[0] != self.DESCRIBE_HEADER:
+            return None
+        return [line for line in lines[1:] if line.strip()]
+
     def test(self):
         """
-        Call the external handler to test whether it should be invoked.
+        Call the external handler to test whether it should be invoked, or
+        test its described sub-handlers in this process.
         """
+        if self._specs is not None:
+            from charms.reactive.cli import test as test_specs
+            self._test_output = test_specs(*self._specs)
+            return bool(self._test_output)
+        if self._test_future is not None:
+            future, self._test_future = self._test_future, None
+            self._test_output, returncode = future.result()
+            return returncode == 0
         # flush to ensure external process can see flags as they currently
         # are, and write flags (flush releases lock)
-        unitdata.kv().flush()
+        _flush_dispatch_state()
+        self._test_output, returncode = self._call_test(_external_call)
+        return returncode == 0
+
+    def _call_test(self, call):
+        tracer().start_external_call(self, 'test')
         try:
-            proc = subprocess.Popen([self._filepath, '--test'], stdout=subprocess.PIPE, env=os.environ)
+            return call(self._run_test)
+        finally:
+            tracer().end_external_call(self, 'test')
+
+    @classmethod
+    def run_tests(cls, handlers):
+        """
+        Run the ``--test`` calls of the given external handlers (other than
+        those tested in this process) concurrently, in up to
+        :data:`TEST_WORKERS` threads, for their :meth:`test` to return the
+        results.
+
+        The calls are read-only by protocol, and the flags cannot change until
+        the handlers have been tested, so they give the same results as when
+        run one by one.  They are run one by one anyway if the CLI server is
+        enabled, as it answers their commands in the main thread.
+
+        Handlers which mention ``when_file_changed`` or ``only_once`` are
+        left to be tested one by one, as those tests open unitdata, and
+        ``when_file_changed`` writes to it, so they would contend for its
+        lock.  The stderr of each concurrent call is written out only once
+        the call has finished, so that the output of different handlers is
+        not interleaved.
+        """
+        to_run = [handler for handler in handlers
+                  if isinstance(handler, cls) and handler._specs is None]
+        for handler in to_run:
+            handler._test_future = None
+        to_run = [handler for handler in to_run if not handler._uses_unitdata()]
+        workers = min(TEST_WORKERS, len(to_run))
+        if workers < 2 or CLI_SERVER:
+            return
+        _flush_dispatch_state()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for handler in to_run:
+                handler._test_future = executor.submit(
+                    handler._call_test, lambda func: func(os.environ, stderr=subprocess.PIPE))
+
+    def _uses_unitdata(self):
+        try:
+            with open(self._filepath, 'rb') as fp:
+                source = fp.read()
+        except OSError:
+            return False
+        return any(test in source for test in self.UNITDATA_TESTS)
+
+    def _run_test(self, env, **kwargs):
+        try:
+            proc = subprocess.Popen([self._filepath, '--test'], stdout=subprocess.PIPE, env=env, **kwargs)
         except OSError as oserr:
             if oserr.errno == errno.ENOEXEC:
                 raise BrokenHandlerException(self._filepath)
             raise
-        self._test_output, _ = proc.communicate()
-        return proc.returncode == 0
+        output, errors = proc.communicate()
+        if errors:
+            with _stderr_lock:
+                sys.stderr.write(errors.decode('utf8', 'replace'))
+                sys.stderr.flush()
+        return output, proc.returncode
 
     def invoke(self):
         """
@@ -257,32 +609,371 @@ class ExternalHandler(Handler):
         """
         # flush to ensure external process can see flags as they currently
         # are, and write flags (flush releases lock)
-        unitdata.kv().flush()
-        subprocess.check_call([self._filepath, '--invoke', self._test_output], env=os.environ)
+        _flush_dispatch_state()
+        tracer().start_external_call(self, 'invoke')
+        _external_call(self._run_invoke)
+        tracer().end_external_call(self, 'invoke')
+        # the handler may have changed flags via the CLI
+        _reload_dispatch_state()
+
+    def _run_invoke(self, env, **kwargs):
+        subprocess.check_call([self._filepath, '--invoke', self._test_output], env=env, **kwargs)
+
+
+def _external_call(func):
+    """
+    Call ``func(env, **popen_kwargs)`` to run an external handler, answering
+    its CLI commands in this process if the
+    :class:`~charms.reactive.cli.CLIServer` is enabled.
+    """
+    if not CLI_SERVER:
+        return func(os.environ)
+    from charms.reactive.cli import CLIServer
+    with CLIServer() as server:
+        return server.serve(func)
+
+
+def _save_dispatch_state():
+    """
+    Mirror the in-memory dispatch state to unitdata for an external handler.
+    """
+    FlagWatch.save()
+    DispatchContext.save()
+
+
+def _flush_dispatch_state():
+    """
+    Save the dispatch state and commit unitdata, so that an external process
+    sees it, but only if there are writes which have not yet been committed.
+    """
+    _save_dispatch_state()
+    kv = unitdata.kv()
+    # a commit is only needed (and only fsyncs) if a write opened a
+    # transaction since the last one; a store whose connection cannot tell
+    # us is always flushed
+    if getattr(kv.conn, 'in_transaction', True):
+        kv.flush()
+
+
+def _reload_dispatch_state():
+    """
+    Re-read the in-memory dispatch state from unitdata after an external
+    handler may have changed it.
+    """
+    FlagCache.reload()
+    FlagWatch.reload()
+    DispatchContext.reload()
+
+
+class FlagCache(object):
+    """
+    In-process copy of the set of active flags.
+
+    While :func:`dispatch` is running, the active flags are loaded once from
+    unitdata and then kept in sync by :func:`~charms.reactive.flags.set_flag`
+    and :func:`~charms.reactive.flags.clear_flag`.  Those still write through
+    to unitdata, so the flags are persisted (or discarded) along with the rest
+    of the kv store, but testing whether a flag is set no longer requires
+    a range scan of the store.
+
+    Outside of dispatch, or if the kv store has been replaced, the flags are
+    read directly from unitdata.
+    """
+    prefix = 'reactive.states.'
+    _store = None
+    _flags = None
+    _mask = 0
+
+    @classmethod
+    def load(cls):
+        cls._store = unitdata.kv()
+        cls._flags = set(cls._store.getrange(cls.prefix, strip=True) or {})
+        cls._mask = FlagBits.mask(cls._flags)
+
+    @classmethod
+    def reload(cls):
+        """
+        Re-read the active flags, if loaded, to pick up changes made by
+        another process, such as an :class:`ExternalHandler`.
+        """
+        if cls._flags is not None:
+            cls.load()
+
+    @classmethod
+    def drop(cls):
+        cls._store = None
+        cls._flags = None
+        cls._mask = 0
+
+    @classmethod
+    def _active(cls):
+        return cls._flags is not None and cls._store is unitdata.kv()
+
+    @classmethod
+    def get(cls):
+        """
+        Return the set of active flags.
+        """
+        if cls._active():
+            return cls._flags
+        return set(unitdata.kv().getrange(cls.prefix, strip=True) or {})
+
+    @classmethod
+    def mask(cls):
+        """
+        Return the :class:`FlagBits` bitmask of the active flags.
+        """
+        if cls._active():
+            return cls._mask
+        return FlagBits.mask(cls.get())
+
+    @classmethod
+    def is_set(cls, flag):
+        if cls._active():
+            return flag in cls._flags
+        missing = object()
+        return unitdata.kv().get(cls.prefix + flag, missing) is not missing
+
+    @classmethod
+    def add(cls, flag):
+        if cls._active():
+            cls._flags.add(flag)
+            cls._mask |= FlagBits.bit(flag)
+
+    @classmethod
+    def discard(cls, flag):
+        if cls._active():
+            cls._flags.discard(flag)
+            cls._mask &= ~FlagBits.bit(flag)
+
+
+class DispatchContext(object):
+    """
+    State of the :func:`dispatch` run in progress: the current dispatch
+    phase, and whether a flag has been removed since the queued handlers
+    were last tested.
+
+    While dispatching, this is held in memory and is only mirrored to
+    unitdata by :meth:`save` for external handlers, which test the phase
+    (and may remove flags) using the ``charms.reactive`` CLI in a separate
+    process.  Outside of dispatch, it is read from and written to unitdata.
+    """
+    phase_key = 'reactive.dispatch.phase'
+    removed_key = 'reactive.dispatch.removed_state'
+    _active = False
+    _phase = None
+    _removed_state = False
+    _dirty = False
+
+    @classmethod
+    def start(cls):
+        """
+        Hold the dispatch state in memory until :meth:`stop` is called.
+        """
+        cls._active = True
+        cls._phase = None
+        cls._removed_state = False
+        cls._dirty = True
+
+    @classmethod
+    def stop(cls):
+        """
+        Persist the final dispatch state and stop holding it in memory.
+        """
+        cls.save()
+        cls._active = False
+        cls._phase = None
+        cls._removed_state = False
+        cls._dirty = False
+
+    @classmethod
+    def phase(cls):
+        """
+        The current dispatch phase: ``restricted``, ``hooks``, or ``other``.
+        """
+        if cls._active:
+            return cls._phase
+        return unitdata.kv().get(cls.phase_key)
+
+    @classmethod
+    def set_phase(cls, phase):
+        if cls._active:
+            cls._phase = phase
+            cls._dirty = True
+        else:
+            unitdata.kv().set(cls.phase_key, phase)
+
+    @classmethod
+    def removed_state(cls):
+        """
+        Whether a flag has been removed since :meth:`set_removed_state` was
+        last called to clear it.
+        """
+        if cls._active:
+            return cls._removed_state
+        return unitdata.kv().get(cls.removed_key, False)
+
+    @classmethod
+    def set_removed_state(cls, removed):
+        if cls._active:
+            cls._removed_state = removed
+            cls._dirty = True
+        else:
+            unitdata.kv().set(cls.removed_key, removed)
+
+    @classmethod
+    def save(cls):
+        """
+        Mirror the in-memory state, if it has changed, to unitdata.
+        """
+        if cls._active and cls._dirty:
+            unitdata.kv().set(cls.phase_key, cls._phase)
+            unitdata.kv().set(cls.removed_key, cls._removed_state)
+            cls._dirty = False
+
+    @classmethod
+    def reload(cls):
+        """
+        Re-read the in-memory state, if any, from unitdata to pick up flag
+        removals made by another process since the last :meth:`save`.
+        """
+        if cls._active:
+            cls._removed_state = unitdata.kv().get(cls.removed_key, False)
+
+
+class LogBuffer(object):
+    """
+    Buffer for the framework's own log messages during :func:`dispatch`.
+
+    Each :func:`hookenv.log <charmhelpers.core.hookenv.log>` call runs
+    ``juju-log``, so rather than logging a message for every handler
+    invoked, the messages are collected and emitted at the start of each
+    dispatch iteration and at the end of dispatch, whether or not it
+    succeeded, with consecutive messages at the same level joined into a
+    single multi-line call.  Messages logged by the handlers themselves are
+    not buffered, so they can appear before the framework messages which
+    preceded them.
+
+    Outside of dispatch, messages are logged immediately.
+    """
+    _msgs = None
+
+    @classmethod
+    def start(cls):
+        cls._msgs = []
+
+    @classmethod
+    def stop(cls):
+        cls.flush()
+        cls._msgs = None
+
+    @classmethod
+    def log(cls, message, level=hookenv.INFO):
+        if cls._msgs is None:
+            hookenv.log(message, level)
+        else:
+            cls._msgs.append((level, message))
+
+    @classmethod
+    def flush(cls):
+        if not cls._msgs:
+            return
+        msgs, cls._msgs = cls._msgs, []
+        for level, group in groupby(msgs, key=lambda msg: msg[0]):
+            hookenv.log('\n'.join(message for _, message in group), level)
 
 
 class FlagWatch(object):
+    """
+    Tracks the flags changed during each iteration of :func:`dispatch`, so
+    that handlers are only re-invoked when one of their flags has changed.
+
+    While dispatching, the state is held in memory and is only mirrored to
+    unitdata by :meth:`save` when an :class:`ExternalHandler` needs to see
+    it.  Outside of dispatch, such as in the ``charms.reactive`` CLI used by
+    external handlers, the state is read from and written to unitdata.
+    """
     key = 'reactive.state_watch'
+    _data = None
+    _dirty = False
 
     @classmethod
     def _store(cls):
         return unitdata.kv()
 
+    @classmethod
+    def _load(cls):
+        data = cls._store().get(cls.key) or {}
+        return {
+            'iteration': data.get('iteration', 0),
+            'changes': set(data.get('changes', [])),
+            'pending': set(data.get('pending', [])),
+        }
+
     @classmethod
     def _get(cls):
-        return cls._store().get(cls.key, {
-            'iteration': 0,
-            'changes': [],
-            'pending': [],
-        })
+        if cls._data is not None:
+            return cls._data
+        return cls._load()
 
     @classmethod
     def _set(cls, data):
-        cls._store().set(cls.key, data)
+        if cls._data is not None:
+            cls._dirty = True
+        else:
+            cls._write(data)
+
+    @classmethod
+    def _write(cls, data):
+        cls._store().set(cls.key, {
+            'iteration': data['iteration'],
+            'changes': sorted(data['changes']),
+            'pending': sorted(data['pending']),
+        })
+
+    @classmethod
+    def start(cls):
+        """
+        Reset the state and hold it in memory until :meth:`stop` is called.
+        """
+        cls.reset()
+        cls._data = cls._load()
+        cls._dirty = False
+
+    @classmethod
+    def stop(cls):
+        """
+        Discard the in-memory state.
+        """
+        cls._data = None
+        cls._dirty = False
+        cls.reset()
+
+    @classmethod
+    def save(cls):
+        """
+        Mirror the in-memory state, if it has changed, to unitdata.
+        """
+        if cls._data is not None and cls._dirty:
+            cls._write(cls._data)
+            cls._dirty = False
+
+    @classmethod
+    def reload(cls):
+        """
+        Re-read the in-memory state, if any, from unitdata to pick up changes
+        made by another process since the last :meth:`save`.
+        """
+        if cls._data is not None:
+            cls._data = cls._load()
+            cls._dirty = False
 
     @classmethod
     def reset(cls):
         cls._store().unset(cls.key)
+        if cls._data is not None:
+            cls._data = cls._load()
+            cls._dirty = False
 
     @classmethod
     def iteration(cls, i):
@@ -294,23 +985,75 @@ class FlagWatch(object):
     def watch(cls, watcher, flags):
         data = cls._get()
         iteration = data['iteration']
-        changed = bool(set(flags) & set(data['changes']))
+        changed = not data['changes'].isdisjoint(flags)
         return iteration == 0 or changed
 
     @classmethod
     def change(cls, flag):
         data = cls._get()
-        data['pending'].append(flag)
+        data['pending'].add(flag)
         cls._set(data)
 
+    @classmethod
+    def changes(cls):
+        """
+        Flags which were changed during the previous iteration.
+        """
+        return cls._get()['changes']
+
     @classmethod
     def commit(cls):
         data = cls._get()
         data['changes'] = data['pending']
-        data['pending'] = []
+        data['pending'] = set()
         cls._set(data)
 
 
+class HandlerIndex(object):
+    """
+    Inverted index from flag names to the handlers which registered them
+    via :meth:`Handler.register_flags`.
+
+    Handlers with registered flags are only re-invoked during a
+    :func:`dispatch` run if one of those flags has changed, so this allows
+    the dispatcher to skip testing every other handler.
+    """
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self._by_flag = {}
+        self._unflagged = []
+        for i, handler in enumerate(self.handlers):
+            flags = getattr(handler, '_flags', None)
+            if not flags:
+                self._unflagged.append(i)
+                continue
+            for flag in flags:
+                self._by_flag.setdefault(flag, []).append(i)
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def affected(self, flags):
+        """
+        Return the handlers which registered any of the given flags, as well
+        as all handlers which registered no flags, in their original order.
+        """
+        positions = set(self._unflagged)
+        for flag in flags:
+            positions.update(self._by_flag.get(flag, ()))
+        return [self.handlers[i] for i in sorted(positions)]
+
+    def watching(self, flags):
+        """
+        Return only the handlers which registered any of the given flags, in
+        their original order.
+        """
+        positions = set()
+        for flag in flags:
+            positions.update(self._by_flag.get(flag, ()))
+        return [self.handlers[i] for i in sorted(positions)]
+
+
 def dispatch(restricted=False):
     """
     Dispatch registered handlers.
@@ -345,19 +1088,44 @@ def dispatch(restricted=False):
       to prevent unnecessary reinvocations, such as
       :func:`~charms.reactive.decorators.only_once`.
     """
-    FlagWatch.reset()
+    FlagWatch.start()
+    FlagCache.load()
+    DispatchContext.start()
+    LogBuffer.start()
+    try:
+        _dispatch(restricted)
+    finally:
+        tracer().end_dispatch()
+        LogBuffer.stop()
+        # lazily imported modules may have registered more handlers
+        RegistrationCache.save()
+        DispatchContext.stop()
+        FlagCache.drop()
+        FlagWatch.stop()
 
+
+def _test_handler(handler):
+    tracer().start_handler_test(handler)
+    result = handler.test()
+    tracer().end_handler_test(handler, result)
+    return result
+
+
+def _dispatch(restricted):
     def _test(to_test):
-        return list(filter(lambda h: h.test(), to_test))
+        ExternalHandler.run_tests(to_test)
+        return list(filter(_test_handler, to_test))
 
     def _invoke(to_invoke):
         while to_invoke:
-            unitdata.kv().set('reactive.dispatch.removed_state', False)
+            DispatchContext.set_removed_state(False)
             for handler in list(to_invoke):
                 to_invoke.remove(handler)
-                hookenv.log('Invoking reactive handler: %s' % handler.id(), level=hookenv.INFO)
+                LogBuffer.log('Invoking reactive handler: %s' % handler.id(), hookenv.INFO)
+                tracer().start_handler_invoke(handler)
                 handler.invoke()
-                if unitdata.kv().get('reactive.dispatch.removed_state'):
+                tracer().end_handler_invoke(handler)
+                if DispatchContext.removed_state():
                     # re-test remaining handlers
                     to_invoke = _test(to_invoke)
                     break
@@ -367,30 +1135,42 @@ def dispatch(restricted=False):
 
     # When in restricted context, only run hooks for that context.
     if restricted:
-        unitdata.kv().set('reactive.dispatch.phase', 'restricted')
+        DispatchContext.set_phase('restricted')
+        LazyModules.load_active()
         hook_handlers = _test(Handler.get_handlers())
         tracer().start_dispatch_phase('restricted', hook_handlers)
         _invoke(hook_handlers)
         return
 
-    unitdata.kv().set('reactive.dispatch.phase', 'hooks')
+    DispatchContext.set_phase('hooks')
+    LazyModules.load_active()
     hook_handlers = _test(Handler.get_handlers())
     tracer().start_dispatch_phase('hooks', hook_handlers)
     _invoke(hook_handlers)
 
-    unitdata.kv().set('reactive.dispatch.phase', 'other')
+    DispatchContext.set_phase('other')
+    index = HandlerIndex(Handler.get_handlers())
     for i in range(100):
         FlagWatch.iteration(i)
-        other_handlers = _test(Handler.get_handlers())
+        LazyModules.load_active()
+        handlers = Handler.get_handlers()
+        if len(handlers) != len(index):
+            # handlers were registered by a previous iteration
+            index = HandlerIndex(handlers)
+        if i == 0:
+            to_test = index.handlers
+        else:
+            # only handlers watching a changed flag (or no flags) can match
+            to_test = index.affected(FlagWatch.changes())
+        other_handlers = _test(to_test)
         if i == 0:
             tracer().start_dispatch_phase('other', other_handlers)
         tracer().start_dispatch_iteration(i, other_handlers)
+        LogBuffer.flush()
         if not other_handlers:
             break
         _invoke(other_handlers)
 
-    FlagWatch.reset()
-
 
 def discover():
     """
@@ -413,17 +1193,431 @@ def discover():
     # for layers to access APIs provided by other layers. This addition
     # needs to remain in effect, in case discovered modules are doing
     # late imports.
-    _append_path(hookenv.charm_dir())
-    _append_path(os.path.join(hookenv.charm_dir(), 'hooks'))
+    charm_dir = hookenv.charm_dir()
+    _append_path(charm_dir)
+    _append_path(os.path.join(charm_dir, 'hooks'))
+    lazy = os.environ.get('CHARMS_REACTIVE_LAZY_IMPORT') == 'true'
+
+    entries = HandlerManifest.load(charm_dir, lazy)
+    if entries is not None:
+        rescanned = False
+        for i, (search_dir, relpath, kind, handlers, mtime) in enumerate(entries):
+            search_path = os.path.join(charm_dir, search_dir)
+            filepath = os.path.join(search_path, relpath)
+            if mtime is not None and _mtime(filepath) != mtime:
+                # edited in place, which leaves its directory's mtime alone
+                mtime = _mtime(filepath)
+                handlers = _scan_module(filepath)
+                entries[i] = [search_dir, relpath, kind, handlers, mtime]
+                rescanned = True
+            if kind == HandlerManifest.EXTERNAL:
+                ExternalHandler.register(filepath)
+            elif handlers is not None:
+                LazyModules.add(search_path, filepath, handlers)
+            else:
+                _load_module(search_path, filepath)
+        if rescanned:
+            HandlerManifest.update(entries)
+        RegistrationCache.save()
+        return
 
-    for search_dir in ('reactive', 'hooks/reactive', 'hooks/relations'):
-        search_path = os.path.join(hookenv.charm_dir(), search_dir)
+    entries = []
+    dirs = []
+    for search_dir in HandlerManifest.SEARCH_DIRS:
+        search_path = os.path.join(charm_dir, search_dir)
+        dirs.append(search_dir)
         for dirpath, dirnames, filenames in os.walk(search_path):
             if os.path.basename(dirpath) == '__pycache__':
                 continue
+            if dirpath != search_path:
+                dirs.append(os.path.relpath(dirpath, charm_dir))
             for filename in filenames:
                 filepath = os.path.join(dirpath, filename)
-                _register_handlers_from_file(search_path, filepath)
+                handlers = mtime = None
+                if lazy and search_dir in LazyModules.SEARCH_DIRS and filepath.endswith('.py'):
+                    mtime = _mtime(filepath)
+                    handlers = _scan_module(filepath)
+                if handlers is not None:
+                    LazyModules.add(search_path, filepath, handlers)
+                    kind = HandlerManifest.MODULE
+                else:
+                    kind = _register_handlers_from_file(search_path, filepath)
+                if kind:
+                    entries.append((search_dir, os.path.relpath(filepath, search_path),
+                                    kind, handlers, mtime))
+    HandlerManifest.save(charm_dir, entries, dirs, lazy)
+    RegistrationCache.save()
+
+
+class HandlerManifest(object):
+    """
+    Record of the handler modules and external handlers found by
+    :func:`discover`, so that later hooks can load them without walking
+    the handler directories and checking every file in them.
+
+    The manifest is stored in unitdata along with the modification times of
+    the directories searched, and is only used while they are unchanged.
+    Adding, removing or renaming a file changes the modification time of
+    its directory, as does a charm upgrade, so the manifest is then rebuilt.
+    Making an existing file executable does not, however.
+
+    In lazy import mode, the manifest also holds the result of statically
+    scanning each module for :class:`LazyModules`, along with the module's
+    modification time, and a module which has since been modified in place
+    is scanned again.
+    """
+    key = 'reactive.discover.manifest'
+    version = 3
+
+    SEARCH_DIRS = ('reactive', 'hooks/reactive', 'hooks/relations')
+    MODULE = 'module'
+    EXTERNAL = 'external'
+
+    @classmethod
+    def fingerprint(cls, charm_dir, dirs):
+        """
+        Map each of the given directories, relative to the charm dir, to its
+        modification time, or ``None`` if it does not exist.
+        """
+        fingerprint = {}
+        for d in dirs:
+            try:
+                fingerprint[d] = os.stat(os.path.join(charm_dir, d)).st_mtime_ns
+            except OSError:
+                fingerprint[d] = None
+        return fingerprint
+
+    @classmethod
+    def load(cls, charm_dir, lazy=False):
+        """
+        Return the list of ``(search_dir, relpath, kind, handlers, mtime)``
+        entries from the stored manifest, or ``None`` if there is none, it is out of
+        date, or it was built for the other import mode.
+        """
+        manifest = unitdata.kv().get(cls.key)
+        if not manifest or manifest.get('version') != cls.version:
+            return None
+        if manifest['lazy'] != lazy:
+            return None
+        fingerprint = manifest['fingerprint']
+        if cls.fingerprint(charm_dir, fingerprint.keys()) != fingerprint:
+            return None
+        return manifest['entries']
+
+    @classmethod
+    def save(cls, charm_dir, entries, dirs, lazy=False):
+        unitdata.kv().set(cls.key, {
+            'version': cls.version,
+            'lazy': lazy,
+            'fingerprint': cls.fingerprint(charm_dir, dirs),
+            'entries': entries,
+        })
+
+    @classmethod
+    def update(cls, entries):
+        """
+        Replace the entries of the stored manifest, keeping its fingerprint.
+        """
+        manifest = unitdata.kv().get(cls.key)
+        manifest['entries'] = entries
+        unitdata.kv().set(cls.key, manifest)
+
+
+class RegistrationCache(object):
+    """
+    Cache of the results of introspecting handler actions as they are
+    registered by the :mod:`decorators <charms.reactive.decorators>`, such
+    as which endpoints a handler applies to, so that later hooks can
+    register the same handlers without repeating it.
+
+    The cache is kept in unitdata, keyed by the charm revision and a hash of
+    ``metadata.yaml``, and is discarded when either changes.  The results for
+    the handlers defined in each file are stored along with the file's
+    modification time, and are also discarded when the file is modified.
+    The cache is not used if the charm has no ``revision`` file.
+    """
+    key = 'reactive.registration_cache'
+
+    _charm_dir = None
+    _cache_key = None
+    _entries = None
+    _mtimes = None
+    _dirty = False
+
+    @classmethod
+    def _load(cls):
+        charm_dir = hookenv.charm_dir()
+        if cls._entries is None or cls._charm_dir != charm_dir:
+            cls._charm_dir = charm_dir
+            cls._cache_key = cls._key(charm_dir)
+            cls._entries = {}
+            cls._mtimes = {}
+            cls._dirty = False
+            data = unitdata.kv().get(cls.key)
+            if cls._cache_key and data and data['key'] == cls._cache_key:
+                cls._entries = data.get('files', {})
+        return cls._entries
+
+    @classmethod
+    def _key(cls, charm_dir):
+        try:
+            with open(os.path.join(charm_dir, 'revision'), 'rb') as fp:
+                revision = fp.read().strip()
+            with open(os.path.join(charm_dir, 'metadata.yaml'), 'rb') as fp:
+                metadata = fp.read()
+        except OSError:
+            return None
+        return '{}:{}'.format(revision.decode('utf8', 'replace'),
+                              hashlib.sha256(metadata).hexdigest())
+
+    @classmethod
+    def _file_mtime(cls, action_id):
+        # action IDs start with the path of the file defining the action
+        filepath = action_id.rsplit(':', 2)[0]
+        if filepath not in cls._mtimes:
+            cls._mtimes[filepath] = _mtime(filepath)
+        return filepath, cls._mtimes[filepath]
+
+    @classmethod
+    def get(cls, action_id):
+        """
+        Return the cached introspection results for the given action, or
+        ``None``.
+        """
+        entries = cls._load()
+        filepath, mtime = cls._file_mtime(action_id)
+        entry = entries.get(filepath)
+        if entry is None or entry['mtime'] != mtime:
+            return None
+        return entry['actions'].get(action_id)
+
+    @classmethod
+    def set(cls, action_id, info):
+        entries = cls._load()
+        filepath, mtime = cls._file_mtime(action_id)
+        if cls._cache_key and mtime is not None:
+            entry = entries.get(filepath)
+            if entry is None or entry['mtime'] != mtime:
+                entry = entries[filepath] = {'mtime': mtime, 'actions': {}}
+            entry['actions'][action_id] = info
+            cls._dirty = True
+
+    @classmethod
+    def save(cls):
+        """
+        Store any new results in unitdata.
+        """
+        if cls._dirty:
+            unitdata.kv().set(cls.key, {'key': cls._cache_key, 'files': cls._entries})
+            cls._dirty = False
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget the loaded cache, so that it is re-read from unitdata.
+        """
+        cls._charm_dir = None
+        cls._cache_key = None
+        cls._entries = None
+        cls._mtimes = None
+        cls._dirty = False
+
+
+class LazyModules(object):
+    """
+    Handler modules whose import has been deferred by :func:`discover`, in
+    lazy import mode, until one of their handlers could match.
+
+    Lazy import mode is enabled by setting the ``CHARMS_REACTIVE_LAZY_IMPORT``
+    environment variable to ``true``.  Each module in the ``reactive``
+    directories is then scanned statically (see :func:`_scan_module`) for the
+    flag conditions and hook patterns of its handlers when the
+    :class:`HandlerManifest` is built, and again if it is modified.  During
+    :func:`dispatch`, a deferred module is imported at the start of the first
+    phase or iteration in which any of its handlers' conditions are met by
+    the active flags, or its hook patterns match the current hook.
+
+    Deferred modules are imported after the :func:`hookenv.atstart
+    <charmhelpers.core.hookenv.atstart>` callbacks have run, so a module
+    which relies on its import having some other effect, such as through a
+    module it imports, must be imported by another module, or not be used
+    with lazy import mode.  Modules defined in ``hooks/relations`` are never
+    deferred.
+    """
+    SEARCH_DIRS = ('reactive', 'hooks/reactive')
+
+    _modules = []
+
+    @classmethod
+    def add(cls, root, filepath, handlers):
+        """
+        Defer importing a module, given the ``{'hooks': patterns}`` or
+        ``{'conditions': [[kind, flags], ...]}`` of each of its handlers.
+        """
+        matchers = []
+        for handler in handlers:
+            if 'hooks' in handler:
+                matchers.append((handler['hooks'], None))
+            else:
+                matchers.append((None, [FlagCondition(kind, flags)
+                                        for kind, flags in handler['conditions']]))
+        cls._modules.append((root, filepath, matchers))
+
+    @classmethod
+    def clear(cls):
+        cls._modules = []
+
+    @classmethod
+    def pending(cls):
+        """
+        Paths of the modules which have not been imported yet.
+        """
+        return [filepath for _, filepath, _ in cls._modules]
+
+    @classmethod
+    def load_active(cls):
+        """
+        Import the deferred modules which have a handler that could match
+        in the current dispatch phase.
+        """
+        if not cls._modules:
+            return
+        phase = DispatchContext.phase()
+        active_flags = FlagCache.get()
+        remaining = []
+        for root, filepath, matchers in cls._modules:
+            if any(cls._can_match(phase, active_flags, hooks, conditions)
+                   for hooks, conditions in matchers):
+                _load_module(root, filepath)
+            else:
+                remaining.append((root, filepath, matchers))
+        cls._modules = remaining
+
+    @classmethod
+    def _can_match(cls, phase, active_flags, hooks, conditions):
+        if hooks is not None:
+            # imported here because helpers depends on this module
+            from charms.reactive.helpers import any_hook
+            return phase in ('hooks', 'restricted') and any_hook(*hooks)
+        return phase == 'other' and all(c.test(active_flags) for c in conditions)
+
+
+_SCAN_CONDITIONS = {
+    'when': FlagCondition.ALL,
+    'when_all': FlagCondition.ALL,
+    'when_any': FlagCondition.ANY,
+    'when_not': FlagCondition.NONE,
+    'when_none': FlagCondition.NONE,
+    'when_not_all': FlagCondition.NOT_ALL,
+}
+
+
+def _scan_module(filepath):
+    """
+    Statically scan a handler module for the conditions under which its
+    handlers can match, for :class:`LazyModules`.
+
+    Returns a list with, for each handler, either ``{'hooks': patterns}`` or
+    ``{'conditions': [[kind, flags], ...]}``.  Returns ``None`` if the module
+    must be imported regardless: if it does anything at the top level other
+    than import names, define functions, and assign literals; or if any
+    decorator is not understood, has arguments which are not literal
+    strings, or leaves a handler able to match without any flag or hook.
+    """
+    try:
+        with open(filepath, 'rb') as fp:
+            tree = ast.parse(fp.read(), filepath)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    handlers = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        if isinstance(node, ast.Expr) and _is_literal(node.value):
+            continue  # docstring
+        if isinstance(node, ast.Assign) and _is_literal(node.value):
+            continue
+        if not isinstance(node, ast.FunctionDef):
+            return None
+        if not node.decorator_list:
+            continue
+        handler = _scan_handler(node)
+        if handler is None:
+            return None
+        if handler:
+            handlers.append(handler)
+    return handlers
+
+
+def _scan_handler(node):
+    hooks = None
+    conditions = []
+    registered = False
+    for decorator in node.decorator_list:
+        call = decorator if isinstance(decorator, ast.Call) else None
+        func = call.func if call else decorator
+        if isinstance(func, ast.Attribute):
+            name = func.attr
+        elif isinstance(func, ast.Name):
+            name = func.id
+        else:
+            return None
+        if name == 'not_unless':
+            continue  # does not register a handler
+        registered = True
+        if name in ('only_once', 'when_file_changed'):
+            continue
+        if name in ('collect_metrics', 'meter_status_changed'):
+            hooks = (hooks or []) + [name.replace('_', '-')]
+            continue
+        args = _literal_strings(call)
+        if args is None:
+            return None
+        if name == 'hook':
+            hooks = (hooks or []) + args
+        elif name in _SCAN_CONDITIONS and not any('{' in flag for flag in args):
+            conditions.append([_SCAN_CONDITIONS[name], args])
+        else:
+            return None
+    if not registered:
+        return {}
+    if hooks is not None:
+        return {'hooks': hooks}
+    if not conditions:
+        return None
+    return {'conditions': conditions}
+
+
+def _literal_strings(call):
+    if call is None or call.keywords:
+        return None
+    args = []
+    for arg in call.args:
+        # literal_eval rather than checking for ast.Constant, which string
+        # literals are not parsed as before Python 3.8
+        try:
+            value = ast.literal_eval(arg)
+        except (ValueError, TypeError, SyntaxError):
+            return None
+        if not isinstance(value, str):
+            return None
+        args.append(value)
+    return args
+
+
+def _is_literal(node):
+    try:
+        ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return False
+    return True
+
+
+def _mtime(filepath):
+    try:
+        return os.stat(filepath).st_mtime_ns
+    except OSError:
+        return None
 
 
 def _append_path(d):
@@ -441,7 +1635,8 @@ def _load_module(root, filepath):
         module = module[:-9]
 
     # Standard import.
-    return importlib.import_module(package + module)
+    with StartupProfiler.measure('discover', package + module):
+        return importlib.import_module(package + module)
 
 
 def _is_external_handler(filepath):
@@ -464,5 +1659,27 @@ def _is_external_handler(filepath):
 def _register_handlers_from_file(root, filepath):
     if filepath.endswith('.py'):
         _load_module(root, filepath)
+        return HandlerManifest.MODULE
     elif _is_external_handler(filepath):
         ExternalHandler.register(filepath)
+        return HandlerManifest.EXTERNAL
+    return None
+
+
+# DEPRECATED: transitional names for backwards compatibility, which are
+# resolved on use because charms.reactive.flags imports this module
+_DEPRECATED_NAMES = {
+    'StateList': 'StateList',
+    'State': 'State',
+    'set_state': 'set_flag',
+    'remove_state': 'clear_flag',
+    'get_state': 'get_state',
+    'get_states': 'get_states',
+}
+
+
+def __getattr__(name):
+    if name not in _DEPRECATED_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    from charms.reactive import flags
+    return getattr(flags, _DEPRECATED_NAMES[name])
@@ -14,11 +14,17 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import inspect
+import io
 import os
+import select
 import shlex
+import socket
+import threading
+import traceback
 
+from charmhelpers.cli import OutputFormatter
 from charmhelpers.cli import cmdline
-from charmhelpers.core import templating
 from charms.reactive import helpers
 from charms.reactive import bus
 
@@ -183,4 +189,121 @@ def render_template(source, target):
     Render a Jinja2 template from $CHARM_DIR/templates using the current
     environment variables as the template context.
     """
+    # imported here, as it is only needed by this subcommand
+    from charmhelpers.core import templating
     templating.render(source, target, os.environ)
+
+
+class CLIServer(object):
+    """
+    Answers ``charms.reactive`` CLI commands from an external handler, such
+    as a Bash handler using ``charms.reactive.sh``, in the dispatching hook
+    process, rather than each command starting a new Python interpreter,
+    importing charms.reactive and opening the unit state database.
+
+    The commands are sent over a Unix socket, whose file descriptor is
+    inherited by the handler and given by the ``CHARMS_REACTIVE_CLI_FD``
+    environment variable.  Each request is the number of arguments followed
+    by the arguments, and each response the exit code followed by the
+    output, all terminated by NUL characters.  The commands are run in the
+    main thread, with the same unitdata connection and in-memory dispatch
+    state as the hook, while the handler is run by another thread.
+
+    This is enabled by setting the ``CHARMS_REACTIVE_CLI_SERVER``
+    environment variable to ``true`` for the hook.
+    """
+    FD_ENV = 'CHARMS_REACTIVE_CLI_FD'
+
+    def __init__(self):
+        self._sock, self._client = socket.socketpair()
+        self._wake_r, self._wake_w = os.pipe()
+        self._buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._sock.close()
+        self._client.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def serve(self, func):
+        """
+        Call ``func(env, pass_fds=...)`` in another thread, to start the
+        external handler with the given environment and the socket passed
+        to it, answering its commands until it returns, and return its result
+        or raise its exception.
+        """
+        env = dict(os.environ, **{self.FD_ENV: str(self._client.fileno())})
+        result = {}
+
+        def _target():
+            try:
+                result['value'] = func(env, pass_fds=(self._client.fileno(),))
+            except BaseException as e:
+                result['error'] = e
+            finally:
+                os.write(self._wake_w, b'.')
+
+        thread = threading.Thread(target=_target, name='charms.reactive CLI')
+        thread.daemon = True
+        thread.start()
+        while True:
+            ready, _, _ = select.select([self._sock, self._wake_r], [], [])
+            if self._sock in ready:
+                self._receive()
+            if self._wake_r in ready:
+                break
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def _receive(self):
+        data = self._sock.recv(65536)
+        if not data:
+            return
+        self._buffer += data
+        while True:
+            fields = self._buffer.split(b'\0')
+            if len(fields) < 2:
+                return
+            count = int(fields[0])
+            if len(fields) < count + 2:
+                return  # incomplete request
+            args = [arg.decode('utf8') for arg in fields[1:count + 1]]
+            self._buffer = b'\0'.join(fields[count + 1:])
+            code, output = self.call(args)
+            self._sock.sendall('{}\0{}\0'.format(code, output).encode('utf8'))
+
+    def call(self, args):
+        """
+        Run a single CLI command in this process, as ``cmdline.run`` would,
+        and return its exit code and output.
+        """
+        outfile = io.StringIO()
+        try:
+            arguments = cmdline.argument_parser.parse_args(args)
+            argspec = inspect.getfullargspec(arguments.func)
+            vargs = [getattr(arguments, arg) for arg in argspec.args]
+            if argspec.varargs:
+                vargs.extend(getattr(arguments, argspec.varargs))
+            output = arguments.func(*vargs)
+            code = 0
+            if getattr(arguments.func, '_cli_test_command', False):
+                code = 0 if output else 1
+                output = ''
+            if getattr(arguments.func, '_cli_no_output', False):
+                output = ''
+            OutputFormatter(outfile=outfile).format_output(output, arguments.format)
+        except SystemExit as e:
+            # e.g. bad arguments, which argparse has already reported
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        # as the CLI would, so that any other process started by the
+        # handler sees the changes, and is not blocked by the lock
+        bus._flush_dispatch_state()
+        return code, outfile.getvalue()
@@ -19,7 +19,9 @@ from inspect import getfile, isclass, signature
 from pathlib import Path
 
 from charmhelpers.core import hookenv
+from charms.reactive.bus import FlagCondition
 from charms.reactive.bus import Handler
+from charms.reactive.bus import RegistrationCache
 from charms.reactive.bus import _action_id
 from charms.reactive.bus import _short_action_id
 from charms.reactive.flags import get_flags
@@ -28,10 +30,6 @@ from charms.reactive.relations import endpoint_from_flag
 from charms.reactive.endpoints import Endpoint
 from charms.reactive.helpers import _hook
 from charms.reactive.helpers import _restricted_hook
-from charms.reactive.helpers import _when_all
-from charms.reactive.helpers import _when_any
-from charms.reactive.helpers import _when_none
-from charms.reactive.helpers import _when_not_all
 from charms.reactive.helpers import any_file_changed
 from charms.reactive.helpers import was_invoked
 from charms.reactive.helpers import mark_invoked
@@ -81,11 +79,11 @@ def hook(*hook_patterns):
     return _register
 
 
-def _when_decorator(predicate, desired_flags, action, legacy_args=False):
-    endpoint_names = _get_endpoint_names(action)
+def _when_decorator(condition, desired_flags, action, legacy_args=False):
+    info = _introspect(action)
+    endpoint_names = info['endpoint_names']
     has_relname_flag = _has_endpoint_name_flag(desired_flags)
-    params = signature(action).parameters
-    has_params = len(params) > 0
+    has_params = info['has_params']
     if has_relname_flag and not endpoint_names:
         # If this is an Endpoint handler but there are no endpoints
         # for this interface & role, then we shouldn't register its
@@ -94,8 +92,8 @@ def _when_decorator(predicate, desired_flags, action, legacy_args=False):
     for endpoint_name in endpoint_names or [None]:
         handler = Handler.get(action, endpoint_name)
         flags = _expand_endpoint_name(endpoint_name, desired_flags)
-        handler.add_predicate(partial(predicate, flags))
-        if _is_endpoint_method(action):
+        handler.add_condition(FlagCondition(condition, flags))
+        if info['endpoint_method']:
             # Endpoint handler methods expect self to be passed in to conform
             # to instance method convention. But mutliple decorators should
             # take care to not pass in multiple copies of self.
@@ -128,7 +126,7 @@ def when_all(*desired_flags):
     recommended to use argument-less handlers.  See
     `the summary <#charms-reactive-decorators>`_ for more information.
     """
-    return partial(_when_decorator, _when_all, desired_flags, legacy_args=True)
+    return partial(_when_decorator, FlagCondition.ALL, desired_flags, legacy_args=True)
 
 
 def when_any(*desired_flags):
@@ -140,7 +138,7 @@ def when_any(*desired_flags):
     Note that handlers whose conditions match are triggered at least once per
     hook invocation.
     """
-    return partial(_when_decorator, _when_any, desired_flags, legacy_args=False)
+    return partial(_when_decorator, FlagCondition.ANY, desired_flags, legacy_args=False)
 
 
 def when_not(*desired_flags):
@@ -160,7 +158,7 @@ def when_none(*desired_flags):
     Note that handlers whose conditions match are triggered at least once per
     hook invocation.
     """
-    return partial(_when_decorator, _when_none, desired_flags, legacy_args=False)
+    return partial(_when_decorator, FlagCondition.NONE, desired_flags, legacy_args=False)
 
 
 def when_not_all(*desired_flags):
@@ -173,7 +171,7 @@ def when_not_all(*desired_flags):
     Note that handlers whose conditions match are triggered at least once per
     hook invocation.
     """
-    return partial(_when_decorator, _when_not_all, desired_flags, legacy_args=False)
+    return partial(_when_decorator, FlagCondition.NOT_ALL, desired_flags, legacy_args=False)
 
 
 def when_file_changed(*filenames, **kwargs):
@@ -267,6 +265,24 @@ def meter_status_changed():
     return _register
 
 
+def _introspect(action):
+    """
+    Get the endpoint names for, and the signature details of, the given
+    handler action, from the :class:`~charms.reactive.bus.RegistrationCache`
+    if possible.
+    """
+    action_id = _action_id(action)
+    info = RegistrationCache.get(action_id)
+    if info is None:
+        info = {
+            'endpoint_names': list(_get_endpoint_names(action)),
+            'endpoint_method': _is_endpoint_method(action),
+            'has_params': len(signature(action).parameters) > 0,
+        }
+        RegistrationCache.set(action_id, info)
+    return info
+
+
 def _has_endpoint_name_flag(flags):
     """
     Detect if the given flags contain any that use ``{endpoint_name}``.
@@ -14,20 +14,28 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
-from collections import UserDict
+from collections import ChainMap, UserDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
 from charmhelpers.core import hookenv, unitdata
+from charms.reactive.bus import _int_env
 from charms.reactive.flags import set_flag, clear_flag, toggle_flag, is_flag_set
-from charms.reactive.helpers import data_changed
 from charms.reactive.relations import RelationFactory, relation_factory
+from charms.reactive.trace import StartupProfiler
+from charms.reactive.trace import tracer
 
 
 __all__ = [
     'Endpoint',
 ]
 
+# number of relation-get calls for the default RelationDataFetcher to run
+# at once; 1 runs them one by one
+RELATION_WORKERS = _int_env('CHARMS_REACTIVE_RELATION_WORKERS', 1)
+
 
 class Endpoint(RelationFactory):
     """
@@ -120,6 +128,8 @@ class Endpoint(RelationFactory):
             if not relf or not issubclass(relf, cls):
                 continue
 
+            StartupProfiler.start('endpoints', endpoint_name)
+            tracer().start_endpoint_startup(endpoint_name)
             rids = sorted(hookenv.relation_ids(endpoint_name))
             # ensure that relation IDs have the endpoint name prefix, in case
             # juju decides to drop it at some point
@@ -132,6 +142,8 @@ class Endpoint(RelationFactory):
             endpoint._manage_flags()
             for relation in endpoint.relations:
                 hookenv.atexit(relation._flush_data)
+            tracer().end_endpoint_startup(endpoint_name)
+            StartupProfiler.stop('endpoints', endpoint_name)
 
     def __init__(self, endpoint_name, relation_ids=None):
         self._endpoint_name = endpoint_name
@@ -233,23 +245,56 @@ class Endpoint(RelationFactory):
         elif self.is_joined:
             clear_flag(self.expand_name('departed'))
 
-        if already_joined and not rel_hook:
+        if already_joined and not rel_hook and hook_name != 'upgrade-charm':
             # skip checking relation data outside hooks for this relation
             # to save on API calls to the controller (unless we didn't have
             # the joined flag before, since then we might migrating to Endpoints)
             return
 
-        for unit in self.all_units:
-            for key, value in unit.received.items():
-                data_key = 'endpoint.{}.{}.{}.{}'.format(self.endpoint_name,
-                                                         unit.relation.relation_id,
-                                                         unit.unit_name,
-                                                         key)
-                if data_changed(data_key, value):
-                    set_flag(self.expand_name('changed'))
-                    set_flag(self.expand_name('changed.{}'.format(key)))
+        digests = ReceivedDigests(self.endpoint_name)
+        partial = already_joined and rel_hook and digests.stored
+        if partial:
+            # only the remote unit of this hook can have changed its data
+            units = self._remote_units()
+            if departed_hook:
+                digests.forget(hookenv.relation_id(), hookenv.remote_unit())
+        else:
+            units = self.all_units
+        self._prefetch_received(units)
+        for unit in units:
+            for key in digests.changed_keys(unit):
+                set_flag(self.expand_name('changed'))
+                set_flag(self.expand_name('changed.{}'.format(key)))
+        digests.save(partial)
         self.manage_flags()
 
+    def _remote_units(self):
+        """
+        The remote unit of the current relation hook, in a list, or an empty
+        list if it is not joined.
+        """
+        relation_id = hookenv.relation_id()
+        unit_name = hookenv.remote_unit()
+        if relation_id not in self.relations.keys():
+            return []
+        units = self.relations[relation_id].joined_units
+        if unit_name not in units.keys():
+            return []
+        return [units[unit_name]]
+
+    def _prefetch_received(self, units):
+        """
+        Fetch the data of the given remote units which have not been read yet
+        at once, using the installed :class:`RelationDataFetcher`.
+        """
+        units = [unit for unit in units if unit._data is None]
+        if not units:
+            return
+        data = relation_data_fetcher().fetch([(unit.relation.relation_id, unit.unit_name)
+                                              for unit in units])
+        for unit in units:
+            unit._data = JSONUnitDataView(data[(unit.relation.relation_id, unit.unit_name)])
+
     def manage_flags(self):
         """
         Method that subclasses can override to perform any flag management
@@ -531,13 +576,19 @@ class Relation:
 
     def _flush_data(self):
         """
-        If this relation's local unit data has been modified, publish it on the
-        relation. This should be automatically called.
+        If this relation's local unit data has been modified, publish the values
+        which have changed on the relation. This should be automatically called.
         """
         if self._data and self._data.modified:
-            hookenv.relation_set(self.relation_id, dict(self.to_publish.data))
+            changes = self._data.raw_data.changes
+            if changes:
+                hookenv.relation_set(self.relation_id, changes)
+                self._data.raw_data._published()
         if self._app_data and self._app_data.modified:
-            hookenv.relation_set(self.relation_id, dict(self.to_publish_app.data), app=True)
+            changes = self._app_data.raw_data.changes
+            if changes:
+                hookenv.relation_set(self.relation_id, changes, app=True)
+                self._app_data.raw_data._published()
 
     def _serialize(self):
         return self.relation_id
@@ -816,10 +867,10 @@ class CombinedUnitsView(KeyList):
         data of all units in this list, with automatic JSON decoding.
         """
         if not hasattr(self, '_data'):
-            # NB: units are reversed so that lowest numbered unit takes precedence
-            self._data = JSONUnitDataView({key: value
-                                           for unit in reversed(self)
-                                           for key, value in unit.received_raw.items()})
+            # chained rather than merged, with the lowest numbered unit first
+            # so that it takes precedence
+            self._data = JSONUnitDataView(ChainMap(*[unit.received_raw.data or {}
+                                                     for unit in self]))
 
         return self._data
 
@@ -843,6 +894,7 @@ class UnitDataView(UserDict):
         self.data = data
         self._writeable = writeable
         self._modified = False
+        self._original = {}
 
     @property
     def modified(self):
@@ -858,6 +910,21 @@ class UnitDataView(UserDict):
         """
         return self._writeable
 
+    @property
+    def changes(self):
+        """
+        A dict of the keys which have been set to a value other than their
+        original one, with their new values.
+        """
+        return {key: self.data[key] for key, value in self._original.items()
+                if key in self.data and self.data[key] != value}
+
+    def _published(self):
+        """
+        Take the current values as the original ones, once they are published.
+        """
+        self._original.clear()
+
     def get(self, key, default=None):
         if self.data is None:
             return default
@@ -870,6 +937,8 @@ class UnitDataView(UserDict):
         if not self._writeable:
             raise ValueError('Remote unit data cannot be modified')
         self._modified = True
+        if key not in self._original:
+            self._original[key] = self.data.get(key)
         self.data[key] = value
 
     def setdefault(self, key, value):
@@ -893,9 +962,14 @@ class JSONUnitDataView(UserDict):
 
     The original data, without automatic encoding / decoding, can be accessed as
     :attr:`raw_data`.
+
+    As the data of a read-only collection cannot change, each of its values is
+    only decoded once, and the same decoded value is returned each time it is
+    accessed.  Copy a decoded value before modifying it.
     """
     def __init__(self, data, writeable=False):
         self.data = UnitDataView(data, writeable)
+        self._decoded = None if writeable else {}
 
     @property
     def raw_data(self):
@@ -926,14 +1000,19 @@ class JSONUnitDataView(UserDict):
         return self[key]
 
     def __getitem__(self, key):
+        if self._decoded is not None and key in self._decoded:
+            return self._decoded[key]
         value = self.raw_data[key]
         if not value:
             return value
         try:
-            return json.loads(value)
+            decoded = json.loads(value)
         except Exception:
             # Catch json.JSONDecodeError when we drop Python 3.4 support.
-            return value
+            decoded = value
+        if self._decoded is not None:
+            self._decoded[key] = decoded
+        return decoded
 
     def __setitem__(self, key, value):
         self.raw_data[key] = json.dumps(value, sort_keys=True)
@@ -944,4 +1023,146 @@ class JSONUnitDataView(UserDict):
         return self[key]
 
 
+class ReceivedDigests(object):
+    """
+    Digests of the data received from each remote unit of an endpoint, to
+    tell which keys of it have changed since it was last checked.
+
+    Each value is digested once decoded, as it was by
+    :func:`~charms.reactive.helpers.data_changed`, so that only a change in
+    its value counts as a change.  The digests are kept in a single unitdata
+    record per endpoint, with one digest of each unit's raw data as a whole,
+    so that the values of units whose raw data has not changed need not be
+    decoded and compared one by one.  They replace the
+    :func:`~charms.reactive.helpers.data_changed` key previously stored for
+    each key of each unit's data, which are read once to migrate them.
+    """
+    prefix = 'reactive.endpoints.digests.'
+
+    def __init__(self, endpoint_name):
+        self._endpoint_name = endpoint_name
+        self._key = self.prefix + endpoint_name
+        self._old = unitdata.kv().get(self._key)
+        self._new = {}
+        self._forgotten = set()
+
+    @property
+    def stored(self):
+        """
+        Whether the digests have been stored before.
+        """
+        return self._old is not None
+
+    @staticmethod
+    def _digest(data):
+        return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+
+    def changed_keys(self, unit):
+        """
+        Return the keys of the given :class:`RelatedUnit`'s received data
+        whose values have changed, and remember its current data.
+        """
+        relation_id = unit.relation.relation_id
+        data = dict(unit.received_raw)
+        digest = self._digest(data)
+        old = (self._old or {}).get(relation_id, {}).get(unit.unit_name)
+        if old and old['digest'] == digest:
+            self._new.setdefault(relation_id, {})[unit.unit_name] = old
+            return []
+        if self._old is None:
+            old_keys = self._data_changed_keys(unit)
+        else:
+            old_keys = old['keys'] if old else {}
+        keys = {key: self._digest(unit.received[key]) for key in data}
+        self._new.setdefault(relation_id, {})[unit.unit_name] = {
+            'digest': digest,
+            'keys': keys,
+        }
+        return sorted(key for key, key_digest in keys.items()
+                      if old_keys.get(key) != key_digest)
+
+    def _data_changed_keys(self, unit):
+        """
+        Return the digests stored by
+        :func:`~charms.reactive.helpers.data_changed` for the keys of the
+        unit's current data.
+        """
+        kv = unitdata.kv()
+        prefix = 'reactive.data_changed.endpoint.{}.{}.{}.'.format(self._endpoint_name,
+                                                                   unit.relation.relation_id,
+                                                                   unit.unit_name)
+        return {key: kv.get(prefix + key) for key in unit.received_raw}
+
+    def forget(self, relation_id, unit_name):
+        """
+        Drop the digests of a departed unit, when saving only some units.
+        """
+        self._forgotten.add((relation_id, unit_name))
+
+    def save(self, partial=False):
+        """
+        Store the digests of the units whose data has been checked, if they
+        have changed.  The digests of any other units are dropped, unless
+        ``partial``, in which case only those forgotten are.
+        """
+        record = self._new
+        if partial:
+            record = {rid: dict(units) for rid, units in self._old.items()}
+            for rid, units in self._new.items():
+                record.setdefault(rid, {}).update(units)
+            for rid, unit_name in self._forgotten:
+                record.get(rid, {}).pop(unit_name, None)
+        if record == self._old:
+            return
+        kv = unitdata.kv()
+        kv.set(self._key, record)
+        if self._old is None:
+            kv.unsetrange(prefix='reactive.data_changed.endpoint.{0}.{0}:'.format(self._endpoint_name))
+
+
+class RelationDataFetcher(object):
+    """
+    Fetches the data of many remote units at once, for :class:`Endpoint` to
+    populate their :attr:`RelatedUnit.received` data when it is going to
+    read all of it anyway.
+
+    Juju has no hook tool to get the data of more than one unit, so this
+    calls ``relation-get`` for each unit.  By default the calls are made one
+    by one.  Up to ``workers`` of them, or by default the number given by the
+    ``CHARMS_REACTIVE_RELATION_WORKERS`` environment variable, can be run at
+    once instead, which only helps if the unit agent answers hook tool calls
+    concurrently.  Another fetcher, such as a fake for tests, can be
+    installed with :func:`install_relation_data_fetcher`.
+    """
+    def __init__(self, workers=None):
+        self.workers = RELATION_WORKERS if workers is None else workers
+
+    def fetch(self, units):
+        """
+        Return a dict of the data of each of the given units, keyed by the
+        ``(relation_id, unit_name)`` tuples given.
+        """
+        def _get(unit):
+            relation_id, unit_name = unit
+            return hookenv.relation_get(unit=unit_name, rid=relation_id)
+
+        units = list(units)
+        if self.workers < 2 or len(units) < 2:
+            return dict(zip(units, map(_get, units)))
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(units))) as executor:
+            return dict(zip(units, executor.map(_get, units)))
+
+
+_relation_data_fetcher = RelationDataFetcher()
+
+
+def install_relation_data_fetcher(fetcher):
+    global _relation_data_fetcher
+    _relation_data_fetcher = fetcher
+
+
+def relation_data_fetcher():
+    return _relation_data_fetcher
+
+
 hookenv.atstart(Endpoint._startup)
@@ -2,6 +2,8 @@ from charmhelpers.cli import cmdline
 from charmhelpers.core import hookenv
 from charmhelpers.core import unitdata
 
+from charms.reactive.bus import DispatchContext
+from charms.reactive.bus import FlagCache
 from charms.reactive.bus import FlagWatch
 from charms.reactive.trace import tracer
 
@@ -76,9 +78,10 @@ def set_flag(flag, value=None):
        complete and successful run of the reactive framework. All unpersisted
        changes are discarded when a hook crashes.
     """
-    old_flags = get_flags()
+    was_set = FlagCache.is_set(flag)
     unitdata.kv().update({flag: value}, prefix='reactive.states.')
-    if flag not in old_flags:
+    FlagCache.add(flag)
+    if not was_set:
         tracer().set_flag(flag)
         FlagWatch.change(flag)
         trigger = _get_trigger(flag, None)
@@ -103,10 +106,11 @@ def clear_flag(flag):
        complete and successful run of the reactive framework. All unpersisted
        changes are discarded when a hook crashes.
     """
-    old_flags = get_flags()
+    was_set = FlagCache.is_set(flag)
     unitdata.kv().unset('reactive.states.%s' % flag)
-    unitdata.kv().set('reactive.dispatch.removed_state', True)
-    if flag in old_flags:
+    FlagCache.discard(flag)
+    DispatchContext.set_removed_state(True)
+    if was_set:
         tracer().clear_flag(flag)
         FlagWatch.change(flag)
         trigger = _get_trigger(None, flag)
@@ -213,7 +217,7 @@ def is_flag_set(flag):
 @cmdline.test_command
 def all_flags_set(*desired_flags):
     """Assert that all desired_flags are set"""
-    active_flags = get_flags()
+    active_flags = FlagCache.get()
     return all(flag in active_flags for flag in desired_flags)
 
 
@@ -221,7 +225,7 @@ def all_flags_set(*desired_flags):
 @cmdline.test_command
 def any_flags_set(*desired_flags):
     """Assert that any of the desired_flags are set"""
-    active_flags = get_flags()
+    active_flags = FlagCache.get()
     return any(flag in active_flags for flag in desired_flags)
 
 
@@ -230,8 +234,7 @@ def get_flags():
     """
     Return a list of all flags which are set.
     """
-    flags = unitdata.kv().getrange('reactive.states.', strip=True) or {}
-    return sorted(flags.keys())
+    return sorted(FlagCache.get())
 
 
 @cmdline.subcommand()
@@ -243,8 +246,7 @@ def get_unset_flags(*desired_flags):
     :returns: list of unset flags filtered from the parameters shared
     :rtype: List[str]
     """
-    flags = unitdata.kv().getrange('reactive.states.', strip=True) or {}
-    return sorted(set(desired_flags) - flags.keys())
+    return sorted(set(desired_flags) - FlagCache.get())
 
 
 def _get_flag_value(flag, default=None):
@@ -22,9 +22,15 @@ from charmhelpers.core import host
 from charmhelpers.core import hookenv
 from charmhelpers.core import unitdata
 from charmhelpers.cli import cmdline
+from charms.reactive.bus import DispatchContext
 from charms.reactive.flags import any_flags_set, all_flags_set
-# import deprecated functions for backwards compatibility
-from charms.reactive.flags import is_state, all_states, any_states  # noqa
+from charms.reactive.flags import is_flag_set, toggle_flag
+
+# DEPRECATED: transitional aliases for backwards compatibility
+is_state = is_flag_set
+toggle_state = toggle_flag
+all_states = all_flags_set
+any_states = any_flags_set
 
 
 __all__ = [
@@ -171,31 +177,31 @@ def is_data_changed(data_id, data, hash_type='md5'):
 
 
 def _hook(hook_patterns):
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'hooks' and any_hook(*hook_patterns)
 
 
 def _restricted_hook(hook_name):
     current_hook = hookenv.hook_name()
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'restricted' and current_hook == hook_name
 
 
 def _when_all(flags):
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'other' and all_flags_set(*flags)
 
 
 def _when_any(flags):
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'other' and any_flags_set(*flags)
 
 
 def _when_none(flags):
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'other' and not any_flags_set(*flags)
 
 
 def _when_not_all(flags):
-    dispatch_phase = unitdata.kv().get('reactive.dispatch.phase')
+    dispatch_phase = DispatchContext.phase()
     return dispatch_phase == 'other' and not all_flags_set(*flags)
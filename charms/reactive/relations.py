@@ -28,8 +28,12 @@ from charms.reactive.flags import set_flag
 from charms.reactive.flags import clear_flag
 from charms.reactive.flags import StateList
 from charms.reactive.bus import _append_path
+from charms.reactive.trace import StartupProfiler
 
-from pkg_resources import iter_entry_points
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:  # Python < 3.8
+    importlib_metadata = None
 
 
 __all__ = [
@@ -113,16 +117,21 @@ class RelationFactory(object):
     This is normally a RelationBase subclass.
     """
     _factories = []
+    _discovered = False
 
     @classmethod
     def discover(cls):
-        for ep in iter_entry_points('charms.reactive.relation_factory'):
-            factory = ep.load()
+        RelationFactory._discovered = True
+        for ep in EntryPointCache.get('charms.reactive.relation_factory'):
+            factory = EntryPointCache.load(ep)
             factory.load()
             RelationFactory._factories.append(factory)
 
     @classmethod
     def get_factory(cls, relation_name):
+        # the installed factories are only looked up once one is needed
+        if not RelationFactory._discovered:
+            RelationFactory.discover()
         for factory in RelationFactory._factories:
             if factory.from_name(relation_name):
                 return factory
@@ -137,6 +146,73 @@ class RelationFactory(object):
         raise NotImplementedError()
 
 
+class EntryPointCache(object):
+    """
+    Cache of the entry points installed in each group, so that finding the
+    :class:`RelationFactory` plugins does not read the metadata of every
+    installed distribution in every hook.
+
+    The cache is stored in unitdata along with the modification times of the
+    entries on ``sys.path``, other than those within the charm dir, and is
+    only used while they are unchanged.  Installing or removing a package
+    changes the modification time of its site-packages directory.
+    """
+    key = 'reactive.entry_points'
+
+    @classmethod
+    def fingerprint(cls):
+        charm_dir = os.path.abspath(hookenv.charm_dir() or os.curdir) + os.sep
+        fingerprint = []
+        for path in sys.path:
+            path = os.path.abspath(path or os.curdir)
+            if (path + os.sep).startswith(charm_dir):
+                continue
+            try:
+                fingerprint.append([path, os.stat(path).st_mtime_ns])
+            except OSError:
+                fingerprint.append([path, None])
+        return fingerprint
+
+    @classmethod
+    def get(cls, group):
+        """
+        Return the list of ``(name, value)`` pairs of the entry points in the
+        given group, where the value is the ``module:attr`` to load.
+        """
+        kv = unitdata.kv()
+        fingerprint = cls.fingerprint()
+        cache = kv.get(cls.key)
+        if not cache or cache.get('fingerprint') != fingerprint:
+            cache = {'fingerprint': fingerprint, 'groups': {}}
+        if group not in cache['groups']:
+            cache['groups'][group] = cls.scan(group)
+            kv.set(cls.key, cache)
+        return [tuple(ep) for ep in cache['groups'][group]]
+
+    @classmethod
+    def scan(cls, group):
+        if importlib_metadata is None:
+            from pkg_resources import iter_entry_points
+            return [[ep.name, '{}:{}'.format(ep.module_name, '.'.join(ep.attrs))]
+                    for ep in iter_entry_points(group)]
+        eps = importlib_metadata.entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=group)
+        else:  # Python < 3.10
+            eps = eps.get(group, [])
+        return [[ep.name, ep.value] for ep in eps]
+
+    @staticmethod
+    def load(ep):
+        name, value = ep
+        module_name, _, attrs = value.partition(':')
+        obj = importlib.import_module(module_name.strip())
+        attrs = attrs.split('[')[0].strip()
+        for attr in attrs.split('.') if attrs else []:
+            obj = getattr(obj, attr)
+        return obj
+
+
 def relation_factory(relation_name):
     """Get the RelationFactory for the given relation name.
 
@@ -167,7 +243,8 @@ def _relation_module(role, interface):
         if module in sys.modules:
             break
         try:
-            importlib.import_module(module)
+            with StartupProfiler.measure('relations', module):
+                importlib.import_module(module)
             break
         except ImportError:
             continue
@@ -935,4 +1012,3 @@ def relation_call(method, relation_name=None, flag=None, state=None, *args):
 
 
 hookenv.atstart(RelationBase._startup)
-RelationFactory.discover()
@@ -1,3 +1,8 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
 from charmhelpers.core import hookenv
 
 import charms.reactive
@@ -30,6 +35,12 @@ class NullTracer(object):
         phases, and is the only phase that invokes this method.
         """
 
+    def end_dispatch(self):
+        """
+        End of handler dispatch, whether successful or not.
+        """
+        pass
+
     def set_flag(self, flag):
         """
         A charms.reactive flag is being set.
@@ -42,6 +53,55 @@ class NullTracer(object):
         """
         pass
 
+    def start_handler_test(self, handler):
+        """
+        A handler is about to be tested by the dispatcher.
+        """
+        pass
+
+    def end_handler_test(self, handler, result):
+        """
+        A handler has been tested by the dispatcher.
+        """
+        pass
+
+    def start_handler_invoke(self, handler):
+        """
+        A handler is about to be invoked.
+        """
+        pass
+
+    def end_handler_invoke(self, handler):
+        """
+        A handler has been invoked.
+        """
+        pass
+
+    def start_external_call(self, handler, mode):
+        """
+        An external handler's executable is about to be run, in
+        either 'test' or 'invoke' mode.
+        """
+        pass
+
+    def end_external_call(self, handler, mode):
+        """
+        An external handler's executable has finished running.
+        """
+        pass
+
+    def start_endpoint_startup(self, endpoint_name):
+        """
+        An endpoint is about to be set up, and its automatic flags managed.
+        """
+        pass
+
+    def end_endpoint_startup(self, endpoint_name):
+        """
+        An endpoint has been set up.
+        """
+        pass
+
 
 class LogTracer(NullTracer):
     """
@@ -53,6 +113,7 @@ class LogTracer(NullTracer):
 
     def __init__(self):
         self._active_handlers = set()
+        self._index = None
         self._msgs = []
 
     def start_dispatch(self):
@@ -74,12 +135,18 @@ class LogTracer(NullTracer):
 
     def start_dispatch_iteration(self, iteration, handlers):
         self._active_handlers = set(handlers)
+        # emit the flag changes of the previous iteration all at once,
+        # because each hookenv.log call runs juju-log
+        self._flush()
+
+    def end_dispatch(self):
+        self._flush()
 
     def set_flag(self, flag):
-        self._flag("set flag {}".format(flag))
+        self._flag("set flag {}".format(flag), flag)
 
     def clear_flag(self, flag):
-        self._flag("cleared flag {}".format(flag))
+        self._flag("cleared flag {}".format(flag), flag)
 
     def _emit(self, msg):
         self._msgs.append("tracer: {}".format(msg))
@@ -88,23 +155,254 @@ class LogTracer(NullTracer):
         if self._msgs:
             if len(self._msgs) > 1:
                 self._msgs.insert(0, "tracer>")
-            hookenv.log("\n".join(self._msgs), self.LEVEL)
+            charms.reactive.bus.LogBuffer.log("\n".join(self._msgs), self.LEVEL)
             self._msgs = []
 
-    def _flag(self, msg):
+    def _flag(self, msg, flag):
         self._emit(msg)
+        handlers = charms.reactive.bus.Handler.get_handlers()
+        if self._index is None or len(self._index) != len(handlers):
+            self._index = charms.reactive.bus.HandlerIndex(handlers)
+
+        # only handlers watching the flag can be (de)queued by its change
         prev_handlers = self._active_handlers
-        next_handlers = set(h for h in charms.reactive.bus.Handler.get_handlers() if h.test())
+        tested = self._index.watching([flag])
+        queued = set(h for h in tested if h.test())
+        tested = set(tested)
 
-        for h in sorted(h.id() for h in (next_handlers - prev_handlers)):
+        for h in sorted(h.id() for h in (queued - prev_handlers)):
             self._emit("++   queue handler {}".format(h))
 
-        for h in sorted(h.id() for h in (prev_handlers - next_handlers)):
+        for h in sorted(h.id() for h in ((tested - queued) & prev_handlers)):
             self._emit("-- dequeue handler {}".format(h))
 
-        self._flush()
+        self._active_handlers = (prev_handlers - tested) | queued
+
+
+class ProfilingTracer(NullTracer):
+    """
+    ProfilingTracer records the time spent testing and invoking each handler,
+    running external handler executables, and setting up each endpoint,
+    and reports it as JSON when the hook exits.
+
+    The report is appended as a single line to the file given by ``path``,
+    or logged to the Juju charm log if no path is given. It is installed
+    instead of the :class:`LogTracer` if the ``CHARMS_REACTIVE_PROFILE``
+    environment variable is set to the path of the report file.
+
+    Expect the report format to change in future releases.
+    """
+    LEVEL = hookenv.DEBUG
+
+    def __init__(self, path=None):
+        self._path = path
+        self._started = None
+        self._iteration = None
+        self._timers = {}
+        self._handlers = {}
+        self._endpoints = {}
+
+    def start_dispatch(self):
+        self._started = time.perf_counter()
+        hookenv.atexit(self.report)
+
+    def start_dispatch_phase(self, phase, handlers):
+        self._iteration = (phase, 0)
+
+    def start_dispatch_iteration(self, iteration, handlers):
+        self._iteration = ('other', iteration)
+
+    def start_handler_test(self, handler):
+        self._start(handler, 'test')
+
+    def end_handler_test(self, handler, result):
+        self._stop(self._stats(handler), handler, 'test')
+
+    def start_handler_invoke(self, handler):
+        self._start(handler, 'invoke')
+
+    def end_handler_invoke(self, handler):
+        stats = self._stats(handler)
+        self._stop(stats, handler, 'invoke')
+        stats['iterations'].add(self._iteration)
+
+    def start_external_call(self, handler, mode):
+        self._start(handler, 'external_' + mode)
+
+    def end_external_call(self, handler, mode):
+        self._stop(self._stats(handler), handler, 'external_' + mode)
+
+    def start_endpoint_startup(self, endpoint_name):
+        self._start(endpoint_name, 'startup')
+
+    def end_endpoint_startup(self, endpoint_name):
+        stats = self._endpoints.setdefault(endpoint_name, {})
+        self._stop(stats, endpoint_name, 'startup')
+
+    def _start(self, key, kind):
+        self._timers[(key, kind)] = time.perf_counter()
+
+    def _stop(self, stats, key, kind):
+        elapsed = time.perf_counter() - self._timers.pop((key, kind))
+        stats[kind + '_calls'] = stats.get(kind + '_calls', 0) + 1
+        stats[kind + '_time'] = stats.get(kind + '_time', 0) + elapsed
+
+    def _stats(self, handler):
+        # keyed by handler rather than id, as the id of an external
+        # handler changes with its test output
+        if handler not in self._handlers:
+            self._handlers[handler] = {'iterations': set()}
+        return self._handlers[handler]
+
+    def report(self):
+        """
+        Emit the collected timings as a JSON report.
+        """
+        handlers = {}
+        for handler, stats in self._handlers.items():
+            stats = dict(stats, iterations=len(stats['iterations']))
+            handlers[handler.id()] = stats
+        report = {
+            'hook': hookenv.hook_name(),
+            'elapsed': time.perf_counter() - self._started if self._started else None,
+            'handlers': handlers,
+            'endpoints': self._endpoints,
+        }
+        data = json.dumps(report, sort_keys=True)
+        if self._path:
+            with open(self._path, 'a') as f:
+                f.write(data + '\n')
+        else:
+            charms.reactive.bus.LogBuffer.log('tracer: profile {}'.format(data), self.LEVEL)
+
+
+class StartupProfiler(object):
+    """
+    StartupProfiler records the time spent in each phase of
+    :func:`charms.reactive.main`, before any handler runs: importing
+    charms.reactive, discovering and importing the handler modules, importing
+    the relation implementations, running the ``atstart`` callbacks, and
+    setting up each endpoint, as well as the dispatch as a whole.
+
+    It is enabled by the ``CHARMS_REACTIVE_STARTUP_PROFILE`` environment
+    variable, which is either the path of the report file, relative to
+    ``$CHARM_DIR``, or ``true`` to write ``reactive-startup-profile.json``
+    alongside the unit state database.  A single JSON line is appended to
+    the report for each hook which completes, with the total time of each
+    phase and the time for each module, callback, or endpoint within it.
+    Note that the phases nest, e.g. the relation implementations are
+    imported during discovery or the endpoint setup.
+
+    Expect the report format to change in future releases.
+    """
+    ENV = 'CHARMS_REACTIVE_STARTUP_PROFILE'
+    DEFAULT_FILENAME = 'reactive-startup-profile.json'
+
+    _phases = None
+    _timers = {}
+
+    @classmethod
+    def enable(cls):
+        cls._phases = {}
+        cls._timers = {}
+
+    @classmethod
+    def disable(cls):
+        cls._phases = None
+        cls._timers = {}
+
+    @classmethod
+    def enabled(cls):
+        return cls._phases is not None
+
+    @classmethod
+    def start(cls, phase, name=None):
+        if cls._phases is not None:
+            cls._timers[(phase, name)] = time.perf_counter()
+
+    @classmethod
+    def stop(cls, phase, name=None):
+        if cls._phases is None:
+            return
+        started = cls._timers.pop((phase, name), None)
+        if started is not None:
+            cls.record(phase, name, time.perf_counter() - started)
+
+    @classmethod
+    def record(cls, phase, name, elapsed):
+        """
+        Record ``elapsed`` seconds against the total of ``phase``, if
+        ``name`` is None, or against the named item within it.
+        """
+        if cls._phases is None:
+            return
+        stats = cls._phases.setdefault(phase, {'total': 0, 'items': {}})
+        if name is None:
+            stats['total'] += elapsed
+        else:
+            stats['items'][name] = stats['items'].get(name, 0) + elapsed
+
+    @classmethod
+    @contextmanager
+    def measure(cls, phase, name=None):
+        cls.start(phase, name)
+        try:
+            yield
+        finally:
+            cls.stop(phase, name)
+
+    @classmethod
+    def wrap_atstart(cls):
+        """
+        Time each of the pending :func:`hookenv.atstart
+        <charmhelpers.core.hookenv.atstart>` callbacks when they are run.
+        """
+        if cls._phases is None:
+            return
+        hookenv._atstart[:] = [(cls._timed('atstart', callback), args, kwargs)
+                               for callback, args, kwargs in hookenv._atstart]
+
+    @classmethod
+    def _timed(cls, phase, func):
+        name = '{}.{}'.format(getattr(func, '__module__', None),
+                              getattr(func, '__qualname__', repr(func)))
+
+        def _wrapper(*args, **kwargs):
+            with cls.measure(phase, name):
+                return func(*args, **kwargs)
+        return _wrapper
+
+    @classmethod
+    def path(cls):
+        path = os.environ.get(cls.ENV)
+        if path == 'true':
+            state_db = os.environ.get('UNIT_STATE_DB',
+                                      os.path.join(hookenv.charm_dir(), '.unit-state.db'))
+            return os.path.join(os.path.dirname(os.path.abspath(state_db)), cls.DEFAULT_FILENAME)
+        return os.path.join(hookenv.charm_dir(), path)
+
+    @classmethod
+    def report(cls):
+        """
+        Append the collected timings to the report file as a JSON line.
+        """
+        if cls._phases is None:
+            return
+        phases = {}
+        for phase, stats in cls._phases.items():
+            total = stats['total'] or sum(stats['items'].values())
+            phases[phase] = dict(stats, total=total)
+        report = {
+            'hook': hookenv.hook_name(),
+            'phases': phases,
+        }
+        with open(cls.path(), 'a') as f:
+            f.write(json.dumps(report, sort_keys=True) + '\n')
+        cls.enable()
+
 
-        self._active_handlers = next_handlers
+if os.environ.get(StartupProfiler.ENV):
+    StartupProfiler.enable()
 
 
 _tracer = None
@@ -131,4 +429,7 @@ install_tracer(NullTracer())
 # handlers. If this is too noisy for some, we can make it optional
 # via layer.yaml. Using hookenv.atstart, because the tests already
 # mock it.
-hookenv.atstart(install_tracer, LogTracer())
+if os.environ.get('CHARMS_REACTIVE_PROFILE'):
+    hookenv.atstart(install_tracer, ProfilingTracer(os.environ['CHARMS_REACTIVE_PROFILE']))
+else:
+    hookenv.atstart(install_tracer, LogTracer())
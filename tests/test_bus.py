@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
 import re
 import sys
@@ -21,6 +22,7 @@ import errno
 import shutil
 import tempfile
 import unittest
+from textwrap import dedent
 import subprocess
 from subprocess import Popen
 from contextlib import contextmanager
@@ -29,6 +31,7 @@ import mock
 
 from charmhelpers.core import unitdata
 from charms import reactive
+from charms.reactive.cli import CLIServer
 
 
 class TestFlagWatch(unittest.TestCase):
@@ -95,7 +98,7 @@ class TestFlagWatch(unittest.TestCase):
         reactive.bus.FlagWatch.change('bar')
         self.assertEqual(self.data, {
             'iteration': 0,
-            'pending': ['foo', 'bar'],
+            'pending': ['bar', 'foo'],
             'changes': [],
         })
 
@@ -106,9 +109,36 @@ class TestFlagWatch(unittest.TestCase):
         self.assertEqual(self.data, {
             'iteration': 0,
             'pending': [],
-            'changes': ['foo', 'bar'],
+            'changes': ['bar', 'foo'],
         })
 
+    def test_in_memory(self):
+        reactive.bus.FlagWatch.start()
+        self.addCleanup(reactive.bus.FlagWatch.stop)
+        reactive.bus.FlagWatch.iteration(1)
+        reactive.bus.FlagWatch.change('foo')
+        reactive.bus.FlagWatch.commit()
+        assert reactive.bus.FlagWatch.watch('foo', ['foo'])
+        self.assertIsNone(self.data)
+
+        reactive.bus.FlagWatch.save()
+        self.assertEqual(self.data, {
+            'iteration': 1,
+            'pending': [],
+            'changes': ['foo'],
+        })
+
+        # changes made by another process are picked up on reload
+        self._data[self.key]['pending'].append('bar')
+        reactive.bus.FlagWatch.reload()
+        reactive.bus.FlagWatch.commit()
+        self.assertEqual(reactive.bus.FlagWatch.changes(), {'bar'})
+
+        reactive.bus.FlagWatch.stop()
+        self.assertIsNone(self.data)
+        reactive.bus.FlagWatch.change('qux')
+        self.assertEqual(self.data['pending'], ['qux'])
+
 
 class TestHandler(unittest.TestCase):
     @classmethod
@@ -174,6 +204,65 @@ class TestHandler(unittest.TestCase):
         reactive.bus.FlagWatch.commit()
         assert handler.test()
 
+    def test_conditions(self):
+        def test_action():
+            pass
+
+        FlagCondition = reactive.bus.FlagCondition
+        self.assertRaises(ValueError, FlagCondition, 'some', ['foo'])
+        active = {'foo', 'bar'}
+        assert FlagCondition('all', ['foo', 'bar']).test(active)
+        assert not FlagCondition('all', ['foo', 'qux']).test(active)
+        assert FlagCondition('any', ['foo', 'qux']).test(active)
+        assert not FlagCondition('any', ['qux']).test(active)
+        assert FlagCondition('none', ['qux']).test(active)
+        assert not FlagCondition('none', ['foo', 'qux']).test(active)
+        assert FlagCondition('not_all', ['foo', 'qux']).test(active)
+        assert not FlagCondition('not_all', ['foo', 'bar']).test(active)
+
+        FlagBits = reactive.bus.FlagBits
+        self.assertEqual(FlagBits.bit('foo'), FlagBits.bit('foo'))
+        self.assertNotEqual(FlagBits.bit('foo'), FlagBits.bit('bar'))
+        self.assertEqual(FlagBits.mask(['foo', 'bar']),
+                         FlagBits.bit('foo') | FlagBits.bit('bar'))
+        mask = FlagBits.mask(active)
+        for kind in ('all', 'any', 'none', 'not_all'):
+            for flags in ([], ['foo'], ['qux'], ['foo', 'bar'], ['foo', 'qux']):
+                cond = FlagCondition(kind, flags)
+                self.assertEqual(cond.test_mask(mask), cond.test(active),
+                                 '%s %s' % (kind, flags))
+        conds = [FlagCondition('all', ['foo']), FlagCondition('none', ['qux']),
+                 FlagCondition('any', ['bar', 'qux']), FlagCondition('not_all', ['foo', 'qux'])]
+        assert reactive.bus.ConditionSet(conds).test_mask(mask)
+        for cond in conds:
+            negated = {'all': 'none', 'none': 'all', 'any': 'none', 'not_all': 'all'}
+            failing = conds + [FlagCondition(negated[cond.kind], cond.flags)]
+            assert not reactive.bus.ConditionSet(failing).test_mask(mask), cond
+
+        pred = mock.Mock(name='pred', return_value=True)
+        handler = reactive.bus.Handler.get(test_action)
+        handler.add_predicate(pred)
+        handler.add_condition(FlagCondition('all', ['foo']))
+        self.assertEqual(handler.conditions, [FlagCondition('all', ['foo'])])
+
+        reactive.set_flag('foo')
+        self.kv.set('reactive.dispatch.phase', 'hooks')
+        assert not handler.test(), 'conditions only match in other phase'
+        self.kv.set('reactive.dispatch.phase', 'other')
+        assert handler.test()
+        reactive.clear_flag('foo')
+        assert not handler.test()
+        self.assertEqual(pred.call_count, 3)
+
+        # predicates after a failing condition are not called
+        pred2 = mock.Mock(name='pred2', return_value=True)
+        handler.add_predicate(pred2)
+        assert not handler.test()
+        assert not pred2.called
+        reactive.set_flag('foo')
+        assert handler.test()
+        self.assertEqual(pred2.call_count, 1)
+
     def test_args(self):
         def test_action():
             pass
@@ -266,6 +355,142 @@ class TestExternalHandler(unittest.TestCase):
         handler.invoke()
         check_call.assert_called_once_with(['filepath', '--invoke', 'output'], env='env')
 
+    @mock.patch.object(reactive.bus.subprocess, 'Popen')
+    def test_run_tests(self, Popen):
+        def _popen(args, **kwargs):
+            proc = mock.Mock()
+            proc.communicate.return_value = (args[0], b'stderr of ' + args[0].encode('utf8') + b'\n')
+            proc.returncode = 0 if args[0] != 'filepath2' else 1
+            return proc
+        Popen.side_effect = _popen
+        handlers = [reactive.bus.ExternalHandler('filepath%d' % i) for i in range(1, 4)]
+        described = reactive.bus.ExternalHandler('described')
+        described._specs = []
+        python_handler = reactive.bus.Handler(lambda: None)
+        watching = reactive.bus.ExternalHandler(os.path.join(self.test_db_dir, 'watching.sh'))
+        with open(watching._filepath, 'w') as fp:
+            fp.write('#!/bin/bash\ncharms.reactive when_file_changed config.yaml\n')
+
+        with mock.patch.object(reactive.bus.sys, 'stderr', new_callable=io.StringIO) as stderr:
+            reactive.bus.ExternalHandler.run_tests(handlers + [described, python_handler, watching])
+        self.assertItemsEqual([c[0][0] for c in Popen.call_args_list],
+                              [['filepath1', '--test'], ['filepath2', '--test'], ['filepath3', '--test']])
+        self.assertTrue(all(c[1]['stderr'] == subprocess.PIPE for c in Popen.call_args_list))
+        # the stderr of each call is written out whole
+        self.assertItemsEqual(stderr.getvalue().splitlines(),
+                              ['stderr of filepath%d' % i for i in range(1, 4)])
+        # handlers using unitdata in their tests are left to run one by one
+        self.assertIsNone(watching._test_future)
+        self.assertEqual([h.test() for h in handlers], [True, False, True])
+        self.assertEqual(handlers[2]._test_output, 'filepath3')
+        # the results are used once
+        self.assertEqual(Popen.call_count, 3)
+        handlers[0].test()
+        self.assertEqual(Popen.call_count, 4)
+
+        # errors are raised by test()
+        Popen.side_effect = OSError(errno.ENOEXEC, 'Exec format error')
+        reactive.bus.ExternalHandler.run_tests(handlers)
+        self.assertRaises(reactive.bus.BrokenHandlerException, handlers[0].test)
+
+        # not run concurrently with a single worker, or the CLI server
+        Popen.reset_mock()
+        for patch in (mock.patch.object(reactive.bus, 'TEST_WORKERS', 1),
+                      mock.patch.object(reactive.bus, 'CLI_SERVER', True)):
+            with patch:
+                reactive.bus.ExternalHandler.run_tests(handlers)
+            assert not Popen.called
+            assert all(h._test_future is None for h in handlers)
+
+    def test_int_env(self):
+        for value, expected in ((None, 4), ('', 4), ('8', 8), ('0', 0), ('four', 1)):
+            env = {} if value is None else {'TEST_INT': value}
+            with mock.patch.dict(os.environ, env):
+                self.assertEqual(reactive.bus._int_env('TEST_INT', 4), expected)
+
+    @mock.patch.object(reactive.bus.subprocess, 'check_call')
+    def test_flush_only_pending(self, check_call):
+        handler = reactive.bus.ExternalHandler('filepath')
+        handler._test_output = 'output'
+        self.kv.flush()
+        with mock.patch.object(self.kv, 'flush', wraps=self.kv.flush) as flush:
+            # nothing written since the last commit
+            handler.invoke()
+            assert not flush.called
+
+            self.kv.set('key', 'value')
+            handler.invoke()
+            flush.assert_called_once_with()
+            assert not self.kv.conn.in_transaction
+
+    def test_describe(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filepath = os.path.join(tmpdir, 'handler.sh')
+        with open(filepath, 'w') as fp:
+            fp.write('#!/bin/bash\n'
+                     '. {}/bin/charms.reactive.sh\n'
+                     '@when "a" "b"\n'
+                     'function both() {{\n    :\n}}\n'
+                     '@when_not "c"\n'
+                     'function not_c() {{\n    :\n}}\n'
+                     'reactive_handler_main\n'.format(
+                         os.path.join(os.path.dirname(__file__), '..')))
+        os.chmod(filepath, 0o755)
+
+        handler = reactive.bus.ExternalHandler.register(filepath)
+        self.assertEqual(len(handler._specs), 2)
+        self.assertEqual(handler._flags, {'a', 'b', 'c'})
+        reactive.set_flag('a')
+        reactive.bus.DispatchContext.set_phase('other')
+        with mock.patch.object(reactive.bus.subprocess, 'Popen') as Popen:
+            assert handler.test()
+            self.assertEqual(handler._test_output, 'not_c')
+            reactive.set_flag('b')
+            assert handler.test()
+            self.assertEqual(sorted(handler._test_output.split(',')), ['both', 'not_c'])
+            assert not Popen.called
+
+            # the description is cached until the file changes
+            reactive.bus.Handler.clear()
+            reactive.bus.ExternalHandler.register(filepath)
+            assert not Popen.called
+            reactive.bus.Handler.clear()
+            os.utime(filepath, ns=(0, 0))
+            Popen.return_value.communicate.return_value = (b'', None)
+            Popen.return_value.returncode = 0
+            handler = reactive.bus.ExternalHandler.register(filepath)
+            Popen.assert_called_once_with([filepath, '--describe'],
+                                          stdout=reactive.bus.subprocess.PIPE, env=os.environ)
+            # without the header, the handler is run with --test as before
+            self.assertIsNone(handler._specs)
+            self.assertEqual(handler._flags, set())
+
+    @mock.patch.object(reactive.bus, 'CLI_SERVER', True)
+    def test_cli_server(self):
+        script = ('. {}/bin/charms.reactive.sh\n'
+                  'set_flag served\n'
+                  'all_flags_set served && echo "set: $(charms.reactive get_flags)"\n'
+                  'charms.reactive is_flag_set no-such-flag || echo "unset"\n')
+        script = script.format(os.path.join(os.path.dirname(__file__), '..'))
+
+        def run(env, **kwargs):
+            return subprocess.check_output(['bash', '-c', script, 'handler', '--invoke'],
+                                           env=env, **kwargs)
+
+        with mock.patch.object(CLIServer, 'call', autospec=True,
+                               side_effect=CLIServer.call) as call:
+            output = reactive.bus._external_call(run)
+        self.assertEqual(output.decode('utf8'), 'set: served\nunset\n')
+        self.assertEqual(call.call_count, 4)
+        assert reactive.helpers.is_flag_set('served')
+
+        with CLIServer() as server:
+            self.assertEqual(server.call(['is_flag_set', 'served']), (0, ''))
+            self.assertEqual(server.call(['--json', 'get_flags']), (0, '["served"]'))
+            with mock.patch('sys.stderr'):
+                self.assertEqual(server.call(['no_such_command']), (2, ''))
+
 
 class TestReactiveBus(unittest.TestCase):
     @classmethod
@@ -318,6 +543,102 @@ class TestReactiveBus(unittest.TestCase):
             mock.call('bar.ready'),
         ])
 
+    def test_flag_cache(self):
+        reactive.set_flag('foo')
+        reactive.bus.FlagCache.load()
+        self.addCleanup(reactive.bus.FlagCache.drop)
+        with mock.patch.object(self.kv, 'getrange') as getrange:
+            assert reactive.is_flag_set('foo')
+            reactive.set_flag('bar')
+            reactive.clear_flag('foo')
+            self.assertEqual(reactive.get_flags(), ['bar'])
+            assert not getrange.called
+
+        self.assertEqual(reactive.bus.FlagCache.mask(),
+                         reactive.bus.FlagBits.bit('bar'))
+
+        # changes are written through to unitdata
+        self.assertEqual(reactive.flags.get_states(), {'bar': None})
+
+        # changes made by another process are picked up on reload
+        self.kv.set('reactive.states.qux', None)
+        self.assertEqual(reactive.get_flags(), ['bar'])
+        reactive.bus.FlagCache.reload()
+        self.assertEqual(reactive.get_flags(), ['bar', 'qux'])
+
+    def test_dispatch_context(self):
+        context = reactive.bus.DispatchContext
+        context.set_phase('hooks')
+        self.assertEqual(self.kv.get('reactive.dispatch.phase'), 'hooks')
+
+        context.start()
+        self.addCleanup(context.stop)
+        context.set_phase('other')
+        reactive.clear_flag('foo')
+        with mock.patch.object(self.kv, 'get') as get:
+            self.assertEqual(context.phase(), 'other')
+            assert context.removed_state()
+            assert reactive.helpers._when_none(['foo'])
+            assert not get.called
+        self.assertEqual(self.kv.get('reactive.dispatch.phase'), 'hooks')
+
+        context.set_removed_state(False)
+        context.save()
+        self.assertEqual(self.kv.get('reactive.dispatch.phase'), 'other')
+        self.assertEqual(self.kv.get('reactive.dispatch.removed_state'), False)
+
+        # flag removals by another process are picked up on reload
+        self.kv.set('reactive.dispatch.removed_state', True)
+        assert not context.removed_state()
+        context.reload()
+        assert context.removed_state()
+
+        context.stop()
+        self.assertEqual(context.phase(), 'other')
+
+    @mock.patch('charmhelpers.core.hookenv.log')
+    def test_log_buffer(self, log):
+        buffer = reactive.bus.LogBuffer
+        buffer.log('direct', 'INFO')
+        log.assert_called_once_with('direct', 'INFO')
+
+        log.reset_mock()
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.log('one', 'INFO')
+        buffer.log('two', 'INFO')
+        buffer.log('three', 'DEBUG')
+        buffer.log('four', 'INFO')
+        assert not log.called
+        buffer.flush()
+        self.assertEqual(log.call_args_list, [
+            mock.call('one\ntwo', 'INFO'),
+            mock.call('three', 'DEBUG'),
+            mock.call('four', 'INFO'),
+        ])
+
+        log.reset_mock()
+        buffer.log('five', 'INFO')
+        buffer.stop()
+        log.assert_called_once_with('five', 'INFO')
+        buffer.log('six', 'INFO')
+        log.assert_called_with('six', 'INFO')
+
+    @mock.patch('charmhelpers.core.hookenv.log')
+    def test_dispatch_log_buffer(self, log):
+        a = mock.Mock(name='a')
+        a1 = lambda: a('h1')
+        a2 = lambda: a('h2')
+        a3 = lambda: a('h3')
+        for action in (a1, a2, a3):
+            reactive.decorators.when('foo')(action)
+        reactive.set_flag('foo')
+        reactive.bus.dispatch()
+        invoking = [c for c in log.call_args_list if 'Invoking reactive handler' in c[0][0]]
+        self.assertEqual(len(invoking), 1)
+        self.assertEqual(invoking[0][0][0].count('Invoking reactive handler'), 3)
+        self.assertEqual(a.call_count, 3)
+
     def test_dispatch(self):
         calls = []
 
@@ -377,6 +698,50 @@ class TestReactiveBus(unittest.TestCase):
             'bar2',
         ])
 
+    def test_dispatch_retests_affected(self):
+        @reactive.when('foo')
+        def foo():
+            reactive.set_flag('bar')
+
+        @reactive.when('bar')
+        def bar():
+            pass
+
+        @reactive.when('qux')
+        def qux():
+            pass
+
+        tested = []
+        test = reactive.bus.Handler.test
+
+        def _test(handler):
+            tested.append(handler._action.__name__)
+            return test(handler)
+
+        reactive.set_flag('foo')
+        with mock.patch.object(reactive.bus.Handler, 'test', autospec=True,
+                               side_effect=_test):
+            reactive.bus.dispatch()
+        # everything is tested in the hooks phase and the first iteration,
+        # but only bar is affected by the flag set in the first iteration
+        self.assertEqual(tested.count('foo'), 2)
+        self.assertEqual(tested.count('bar'), 3)
+        self.assertEqual(tested.count('qux'), 2)
+
+    def test_handler_index(self):
+        h1 = mock.Mock(_flags={'foo'})
+        h2 = mock.Mock(_flags={'foo', 'bar'})
+        h3 = mock.Mock(_flags=set())
+        h4 = mock.Mock(_flags={'qux'})
+        index = reactive.bus.HandlerIndex([h1, h2, h3, h4])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.affected([]), [h3])
+        self.assertEqual(index.affected(['bar']), [h2, h3])
+        self.assertEqual(index.affected(['foo', 'qux']), [h1, h2, h3, h4])
+        self.assertEqual(index.watching([]), [])
+        self.assertEqual(index.watching(['bar']), [h2])
+        self.assertEqual(index.watching(['foo', 'qux']), [h1, h2, h4])
+
     @mock.patch.object(reactive.bus.Handler, 'get_handlers')
     def test_dispatch_remove(self, get_handlers):
         a = mock.Mock(name='a')
@@ -454,6 +819,206 @@ class TestReactiveBus(unittest.TestCase):
         sys.path.pop()  # Repair sys.path
         sys.path.pop()
 
+    @mock.patch.dict('sys.modules')
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_discover_manifest(self, charm_dir):
+        test_dir = os.path.dirname(__file__)
+        charm_dir.return_value = os.path.join(test_dir, 'data')
+        self.addCleanup(sys.path.remove, charm_dir() + '/hooks')
+        self.addCleanup(sys.path.remove, charm_dir())
+        manifest = reactive.bus.HandlerManifest
+
+        with mock.patch.object(reactive.bus, '_load_module',
+                               wraps=reactive.bus._load_module) as _load_module:
+            reactive.bus.discover()
+        modules = _load_module.call_args_list
+        handlers = reactive.bus.Handler.get_handlers()
+        external = sorted(h._filepath for h in handlers if isinstance(h, reactive.bus.ExternalHandler))
+        stored = self.kv.get(manifest.key)
+        self.assertIn('hooks/relations/test', stored['fingerprint'])
+        self.assertEqual(len(stored['entries']), len(modules) + len(external))
+
+        # a matching manifest is loaded without walking the directories
+        reactive.bus.Handler.clear()
+        with mock.patch.object(reactive.bus, '_load_module') as _load_module, \
+                mock.patch.object(reactive.bus.os, 'walk') as walk, \
+                mock.patch.object(reactive.bus, '_is_external_handler') as _is_external_handler:
+            reactive.bus.discover()
+        assert not walk.called
+        assert not _is_external_handler.called
+        self.assertEqual(_load_module.call_args_list, modules)
+        self.assertEqual(sorted(h._filepath for h in reactive.bus.Handler.get_handlers()), external)
+
+        # a changed directory invalidates it
+        stored['fingerprint']['reactive'] -= 1
+        self.kv.set(manifest.key, stored)
+        with mock.patch.object(reactive.bus, '_load_module') as _load_module:
+            reactive.bus.discover()
+        self.assertEqual(_load_module.call_args_list, modules)
+        self.assertEqual(self.kv.get(manifest.key)['fingerprint']['reactive'],
+                         stored['fingerprint']['reactive'] + 1)
+
+    def test_scan_module(self):
+        def scan(source):
+            filepath = os.path.join(self.test_db_dir, 'scanned.py')
+            with open(filepath, 'w') as fp:
+                fp.write(dedent(source))
+            return reactive.bus._scan_module(filepath)
+
+        self.assertEqual(scan('''
+            """Docstring."""
+            from charms.reactive import when, when_any, when_not, hook
+            from charms import reactive
+            KEY = 'value'
+
+            @when('foo', 'bar')
+            @reactive.when_not('qux')
+            def handler1():
+                pass
+
+            @when_any('foo', 'bar')
+            @reactive.decorators.only_once
+            def handler2():
+                pass
+
+            @hook('{requires:mysql}-relation-joined')
+            def handler3():
+                pass
+
+            @reactive.collect_metrics()
+            def handler4():
+                pass
+
+            @reactive.not_unless('foo')
+            def helper():
+                pass
+        '''), [
+            {'conditions': [['all', ['foo', 'bar']], ['none', ['qux']]]},
+            {'conditions': [['any', ['foo', 'bar']]]},
+            {'hooks': ['{requires:mysql}-relation-joined']},
+            {'hooks': ['collect-metrics']},
+        ])
+        self.assertEqual(scan('''
+            def helper():
+                pass
+        '''), [])
+        # top-level side effects
+        self.assertIsNone(scan('''
+            from charms.reactive import register_trigger
+            register_trigger(when='foo', set_flag='bar')
+        '''))
+        self.assertIsNone(scan('''
+            from charmhelpers.core import hookenv
+            CONFIG = hookenv.config()
+        '''))
+        # handlers which can match without any flag or hook
+        self.assertIsNone(scan('''
+            @only_once
+            def handler():
+                pass
+        '''))
+        # unknown decorators or non-literal arguments
+        self.assertIsNone(scan('''
+            @when('foo')
+            @custom_decorator
+            def handler():
+                pass
+        '''))
+        self.assertIsNone(scan('''
+            FLAGS = ['foo']
+
+            @when(*FLAGS)
+            def handler():
+                pass
+        '''))
+        self.assertIsNone(scan('''
+            @when('endpoint.{endpoint_name}.joined')
+            def handler():
+                pass
+        '''))
+        self.assertIsNone(scan('def broken(:'))
+
+    @mock.patch('charms.reactive.helpers.any_hook')
+    @mock.patch.object(reactive.bus, '_load_module')
+    def test_lazy_modules(self, _load_module, any_hook):
+        lazy = reactive.bus.LazyModules
+        self.addCleanup(lazy.clear)
+        lazy.add('root', 'flags.py', [
+            {'conditions': [['all', ['foo']], ['none', ['bar']]]},
+            {'conditions': [['any', ['qux']]]},
+        ])
+        lazy.add('root', 'hooks.py', [{'hooks': ['install']}])
+        any_hook.return_value = False
+
+        reactive.bus.DispatchContext.set_phase('hooks')
+        lazy.load_active()
+        any_hook.assert_called_once_with('install')
+        assert not _load_module.called
+
+        any_hook.return_value = True
+        lazy.load_active()
+        _load_module.assert_called_once_with('root', 'hooks.py')
+        self.assertEqual(lazy.pending(), ['flags.py'])
+
+        _load_module.reset_mock()
+        reactive.bus.DispatchContext.set_phase('other')
+        reactive.set_flag('foo')
+        reactive.set_flag('bar')
+        lazy.load_active()
+        assert not _load_module.called
+        reactive.set_flag('qux')
+        lazy.load_active()
+        _load_module.assert_called_once_with('root', 'flags.py')
+        self.assertEqual(lazy.pending(), [])
+
+    @mock.patch.dict('sys.modules')
+    @mock.patch.dict(os.environ, {'CHARMS_REACTIVE_LAZY_IMPORT': 'true'})
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_discover_lazy(self, charm_dir):
+        test_dir = os.path.dirname(__file__)
+        charm_dir.return_value = os.path.join(test_dir, 'data')
+        self.addCleanup(sys.path.remove, charm_dir() + '/hooks')
+        self.addCleanup(sys.path.remove, charm_dir())
+        self.addCleanup(reactive.bus.LazyModules.clear)
+        lazy = reactive.bus.LazyModules
+
+        reactive.bus.discover()
+        pending = [os.path.relpath(p, charm_dir()) for p in lazy.pending()]
+        self.assertEqual(sorted(pending), ['reactive/nested/nested.py', 'reactive/top_level.py'])
+        self.assertEqual(len(reactive.bus.Handler.get_handlers()), 15)
+        self.assertIs(self.kv.get(reactive.bus.HandlerManifest.key)['lazy'], True)
+
+        reactive.bus.DispatchContext.set_phase('other')
+        lazy.load_active()
+        self.assertEqual(lazy.pending(), [os.path.join(charm_dir(), 'reactive/nested/nested.py')])
+        reactive.set_flag('test')
+        lazy.load_active()
+        self.assertEqual(lazy.pending(), [])
+        self.assertEqual(len(reactive.bus.Handler.get_handlers()), 19)
+
+        # the scan is kept in the manifest
+        reactive.bus.Handler.clear()
+        with mock.patch.object(reactive.bus, '_scan_module') as _scan_module:
+            reactive.bus.discover()
+        assert not _scan_module.called
+        self.assertEqual(len(lazy.pending()), 2)
+
+        # a module modified in place is scanned again
+        manifest = self.kv.get(reactive.bus.HandlerManifest.key)
+        entry = [e for e in manifest['entries'] if e[1] == 'top_level.py'][0]
+        mtime = entry[4]
+        entry[4] -= 1
+        self.kv.set(reactive.bus.HandlerManifest.key, manifest)
+        reactive.bus.Handler.clear()
+        lazy.clear()
+        with mock.patch.object(reactive.bus, '_scan_module',
+                               wraps=reactive.bus._scan_module) as _scan_module:
+            reactive.bus.discover()
+        _scan_module.assert_called_once_with(os.path.join(charm_dir(), 'reactive/top_level.py'))
+        self.assertEqual(len(lazy.pending()), 2)
+        manifest = self.kv.get(reactive.bus.HandlerManifest.key)
+        self.assertIn([entry[0], entry[1], entry[2], entry[3], mtime], manifest['entries'])
+
     @mock.patch.dict('sys.modules')
     @mock.patch('charmhelpers.core.hookenv.relation_to_role_and_interface')
     @mock.patch('subprocess.check_call')
@@ -535,17 +1100,15 @@ class TestReactiveBus(unittest.TestCase):
             invoked = ['test_when_not_all', 'test_when_any', 'test_when',
                        'test_when_not', 'test_multi', 'test_only_once']
             invoked.sort()
-            stdout_invoked = mPopen.stdout[0].split(',')
-            stdout_invoked.sort()
-            self.assertEqual(stdout_invoked, invoked)
-            stderr_invoked = next(
-                line for line in mPopen.stderr
-                if line.startswith("Will invoke:")
-            )[13:].split(',')
-            stderr_invoked.sort()
+            # the bash handlers are described once, then tested natively
+            self.assertEqual(mPopen.stdout[0], 'charms.reactive describe 1')
+            assert 'Running reactive_handler_main for bash.sh (test)' not in mPopen.stderr
+            stderr_invoked = sorted(
+                line[len('Invoking bash reactive handler: '):]
+                for line in mPopen.stderr
+                if line.startswith('Invoking bash reactive handler: ')
+            )
             self.assertEqual(stderr_invoked, invoked)
-            for handler in invoked:
-                assert 'Invoking bash reactive handler: %s' % handler in mPopen.stderr
             assert '++ charms.reactive set_flag bash-when-not-all' in mPopen.stderr
             bash_debug = False
             debug_debug = False
@@ -580,6 +1143,17 @@ class TestReactiveBus(unittest.TestCase):
         sys.path.pop()  # Repair sys.path
         sys.path.pop()
 
+    @mock.patch.object(reactive.bus, 'CLI_SERVER', True)
+    def test_full_stack_with_cli_server(self):
+        with mock.patch.object(CLIServer, 'call', autospec=True,
+                               side_effect=CLIServer.call) as call:
+            self.test_full_stack()
+        commands = [c[0][1] for c in call.call_args_list]
+        self.assertIn(['set_flag', 'bash-when-not-all'], commands)
+        # described handlers are tested without running them
+        self.assertNotIn('test', [c[0] for c in commands])
+        self.assertIn('mark_invoked', [c[0] for c in commands])
+
     @mock.patch('charmhelpers.core.hookenv.log')
     def test_full_stack_with_tracing(self, log):
         self.addCleanup(reactive.trace.install_tracer, reactive.trace.NullTracer())
@@ -591,6 +1165,12 @@ class TestReactiveBus(unittest.TestCase):
         tracer.start_dispatch_phase.assert_any_call('hooks', mock.ANY)
         tracer.start_dispatch_phase.assert_any_call('other', mock.ANY)
         tracer.start_dispatch_iteration.assert_any_call(0, mock.ANY)
+        tracer.start_handler_test.assert_called()
+        tracer.end_handler_test.assert_called()
+        tracer.start_handler_invoke.assert_called()
+        tracer.end_handler_invoke.assert_called()
+        tracer.start_external_call.assert_any_call(mock.ANY, 'test')
+        tracer.end_external_call.assert_any_call(mock.ANY, 'invoke')
 
     @mock.patch.object(reactive.bus.importlib, 'import_module')
     def test_load_module_py3(self, import_module):
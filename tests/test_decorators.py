@@ -79,10 +79,11 @@ class TestReactiveDecorators(unittest.TestCase):
 
     @mock.patch.object(reactive.decorators, 'endpoint_from_flag')
     @mock.patch.object(reactive.decorators, '_action_id')
-    @mock.patch.object(reactive.decorators, '_when_all')
-    def test_when_all(self, _when_all, _action_id, from_flag):
+    def test_when_all(self, _action_id, from_flag):
         reactive.bus.Handler._CONSUMED_FLAGS.clear()
-        _when_all.return_value = True
+        self.kv.set('reactive.dispatch.phase', 'other')
+        for flag in ('foo', 'bar', 'qux'):
+            reactive.set_flag(flag)
         _action_id.return_value = 'f:l:test_action'
         from_flag.side_effect = [None, 'rel', None]
         action = mock.Mock(name='action')
@@ -95,7 +96,9 @@ class TestReactiveDecorators(unittest.TestCase):
         assert handler.test()
         handler.invoke()
 
-        _when_all.assert_called_once_with(('foo', 'bar', 'qux'))
+        self.assertEqual(handler.conditions, [
+            reactive.bus.FlagCondition(reactive.bus.FlagCondition.ALL, ('foo', 'bar', 'qux')),
+        ])
         self.assertEqual(from_flag.call_args_list, [
             mock.call('foo'),
             mock.call('bar'),
@@ -109,6 +112,69 @@ class TestReactiveDecorators(unittest.TestCase):
         handler.invoke()
         action.assert_called_once_with('rel')
 
+    @mock.patch.object(reactive.decorators, '_is_endpoint_method')
+    @mock.patch.object(reactive.decorators, '_get_endpoint_names')
+    def test_registration_cache(self, _get_endpoint_names, _is_endpoint_method):
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        self.addCleanup(reactive.bus.RegistrationCache.reset)
+        with open(os.path.join(charm_dir, 'revision'), 'w') as fp:
+            fp.write('3\n')
+        with open(os.path.join(charm_dir, 'metadata.yaml'), 'w') as fp:
+            fp.write('name: test\n')
+        _get_endpoint_names.return_value = []
+        _is_endpoint_method.return_value = False
+
+        def test_action():
+            pass
+
+        def register():
+            reactive.bus.Handler.clear()
+            reactive.bus.RegistrationCache.reset()
+            reactive.when('foo')(test_action)
+            reactive.bus.RegistrationCache.save()
+            return reactive.bus.Handler.get(test_action)
+
+        with mock.patch('charmhelpers.core.hookenv.charm_dir', lambda: charm_dir):
+            handler = register()
+            self.assertEqual(handler._flags, {'foo'})
+            self.assertEqual(_get_endpoint_names.call_count, 1)
+            cached = self.kv.get(reactive.bus.RegistrationCache.key)
+            self.assertEqual(cached['key'].split(':')[0], '3')
+            cached_file = cached['files'][test_action.__code__.co_filename]
+            self.assertEqual(cached_file['mtime'], os.stat(__file__).st_mtime_ns)
+            self.assertEqual(cached_file['actions'][reactive.bus._action_id(test_action)], {
+                'endpoint_names': [],
+                'endpoint_method': False,
+                'has_params': False,
+            })
+
+            # a warm registration skips the introspection
+            handler = register()
+            self.assertEqual(handler._flags, {'foo'})
+            self.assertEqual(_get_endpoint_names.call_count, 1)
+            self.assertEqual(_is_endpoint_method.call_count, 1)
+
+            # but not once the handler's file is modified
+            with mock.patch.object(reactive.bus, '_mtime', return_value=1):
+                register()
+                register()
+            self.assertEqual(_get_endpoint_names.call_count, 2)
+            register()
+            self.assertEqual(_get_endpoint_names.call_count, 3)
+
+            # nor once metadata.yaml changes
+            with open(os.path.join(charm_dir, 'metadata.yaml'), 'w') as fp:
+                fp.write('name: test\nrequires: {}\n')
+            register()
+            self.assertEqual(_get_endpoint_names.call_count, 4)
+
+            # nor without a revision
+            os.remove(os.path.join(charm_dir, 'revision'))
+            register()
+            register()
+            self.assertEqual(_get_endpoint_names.call_count, 6)
+
     @mock.patch.object(reactive.decorators, 'when_all')
     def test_when(self, when_all):
         @reactive.when('foo', 'bar', 'qux')
@@ -118,10 +184,10 @@ class TestReactiveDecorators(unittest.TestCase):
 
     @mock.patch.object(reactive.decorators, 'endpoint_from_flag')
     @mock.patch.object(reactive.decorators, '_action_id')
-    @mock.patch.object(reactive.decorators, '_when_any')
-    def test_when_any(self, _when_any, _action_id, from_flag):
+    def test_when_any(self, _action_id, from_flag):
         reactive.bus.Handler._CONSUMED_FLAGS.clear()
-        _when_any.return_value = True
+        self.kv.set('reactive.dispatch.phase', 'other')
+        reactive.set_flag('bar')
         _action_id.return_value = 'f:l:test_action'
         from_flag.side_effect = [None, 'rel', None]
         action = mock.Mock(name='action')
@@ -134,17 +200,18 @@ class TestReactiveDecorators(unittest.TestCase):
         assert handler.test()
         handler.invoke()
 
-        _when_any.assert_called_once_with(('foo', 'bar', 'qux'))
+        self.assertEqual(handler.conditions, [
+            reactive.bus.FlagCondition(reactive.bus.FlagCondition.ANY, ('foo', 'bar', 'qux')),
+        ])
         assert not from_flag.called
         action.assert_called_once_with()
         self.assertEqual(reactive.bus.Handler._CONSUMED_FLAGS, set(['foo', 'bar', 'qux']))
 
     @mock.patch.object(reactive.decorators, 'endpoint_from_flag')
     @mock.patch.object(reactive.decorators, '_action_id')
-    @mock.patch.object(reactive.decorators, '_when_none')
-    def test_when_none(self, _when_none, _action_id, from_flag):
+    def test_when_none(self, _action_id, from_flag):
         reactive.bus.Handler._CONSUMED_FLAGS.clear()
-        _when_none.return_value = True
+        self.kv.set('reactive.dispatch.phase', 'other')
         _action_id.return_value = 'f:l:test_action'
         from_flag.return_value = 'rel'
         action = mock.Mock(name='action')
@@ -157,7 +224,9 @@ class TestReactiveDecorators(unittest.TestCase):
         assert handler.test()
         handler.invoke()
 
-        _when_none.assert_called_once_with(('foo', 'bar', 'qux'))
+        self.assertEqual(handler.conditions, [
+            reactive.bus.FlagCondition(reactive.bus.FlagCondition.NONE, ('foo', 'bar', 'qux')),
+        ])
         assert not from_flag.called
         action.assert_called_once_with()
         self.assertEqual(reactive.bus.Handler._CONSUMED_FLAGS, set(['foo', 'bar', 'qux']))
@@ -171,10 +240,10 @@ class TestReactiveDecorators(unittest.TestCase):
 
     @mock.patch.object(reactive.decorators, 'endpoint_from_flag')
     @mock.patch.object(reactive.decorators, '_action_id')
-    @mock.patch.object(reactive.decorators, '_when_not_all')
-    def test_when_not_all(self, _when_not_all, _action_id, from_flag):
+    def test_when_not_all(self, _action_id, from_flag):
         reactive.bus.Handler._CONSUMED_FLAGS.clear()
-        _when_not_all.return_value = True
+        self.kv.set('reactive.dispatch.phase', 'other')
+        reactive.set_flag('foo')
         _action_id.return_value = 'f:l:test_action'
         from_flag.return_value = 'rel'
         action = mock.Mock(name='action')
@@ -187,7 +256,9 @@ class TestReactiveDecorators(unittest.TestCase):
         assert handler.test()
         handler.invoke()
 
-        _when_not_all.assert_called_once_with(('foo', 'bar', 'qux'))
+        self.assertEqual(handler.conditions, [
+            reactive.bus.FlagCondition(reactive.bus.FlagCondition.NOT_ALL, ('foo', 'bar', 'qux')),
+        ])
         assert not from_flag.called
         action.assert_called_once_with()
         self.assertEqual(reactive.bus.Handler._CONSUMED_FLAGS, set(['foo', 'bar', 'qux']))
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import sys
 import mock
 import tempfile
@@ -29,6 +30,25 @@ from charms.reactive import (
     register_trigger,
 )
 from charms.reactive.bus import discover, dispatch, Handler
+from charms.reactive.endpoints import ReceivedDigests
+# imported before sys.modules is patched, as the CLI commands can only be
+# registered once
+import charms.reactive.cli  # noqa: F401
+
+
+def forget_received():
+    # as if none of the data currently received had been seen before
+    unitdata.kv().unsetrange(prefix=ReceivedDigests.prefix)
+
+
+def remember_received(relations):
+    # as if all of the data currently received had been seen in a prior hook
+    for endpoint_name, endpoint_relations in relations.items():
+        rids = ['{}:{}'.format(endpoint_name, i) for i in range(len(endpoint_relations))]
+        digests = ReceivedDigests(endpoint_name)
+        for unit in Endpoint(endpoint_name, rids).all_joined_units:
+            digests.changed_keys(unit)
+        digests.save()
 
 
 class TestEndpoint(unittest.TestCase):
@@ -120,9 +140,6 @@ class TestEndpoint(unittest.TestCase):
         self.rel_set_p = mock.patch('charmhelpers.core.hookenv.relation_set')
         self.relation_set = self.rel_set_p.start()
 
-        self.data_changed_p = mock.patch('charms.reactive.endpoints.data_changed')
-        self.data_changed = self.data_changed_p.start()
-
         self.atexit_p = mock.patch('charmhelpers.core.hookenv.atexit')
         self.atexit = self.atexit_p.start()
 
@@ -154,7 +171,6 @@ class TestEndpoint(unittest.TestCase):
         self.rel_units_p.stop()
         self.rel_get_p.stop()
         self.rel_set_p.stop()
-        self.data_changed_p.stop()
         self.atexit_p.stop()
         self.test_db.unlink()
         self.sysm_p.stop()
@@ -197,7 +213,6 @@ class TestEndpoint(unittest.TestCase):
             register_trigger(when=joined_flag, set_flag=alias_joined_flag)
             register_trigger(when_not=joined_flag, clear_flag=alias_joined_flag)
 
-        self.data_changed.return_value = True
         with mock.patch.object(Endpoint, 'register_triggers',
                                _register_triggers):
             Endpoint._startup()
@@ -232,6 +247,7 @@ class TestEndpoint(unittest.TestCase):
 
         # relation hook
         self.hook_name = 'test-endpoint-relation-joined'
+        forget_received()
         clear_flag('endpoint.test-endpoint.changed')
         clear_flag('endpoint.test-endpoint.changed.foo')
         Endpoint._startup()
@@ -240,6 +256,7 @@ class TestEndpoint(unittest.TestCase):
 
         # not already joined
         self.hook_name = 'upgrade-charm'
+        forget_received()
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
         clear_flag('endpoint.test-endpoint.changed.foo')
@@ -248,7 +265,6 @@ class TestEndpoint(unittest.TestCase):
         assert is_flag_set('endpoint.test-endpoint.changed.foo')
 
         # data not changed
-        self.data_changed.return_value = False
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
         clear_flag('endpoint.test-endpoint.changed.foo')
@@ -280,6 +296,159 @@ class TestEndpoint(unittest.TestCase):
         self.assertIs(tep.all_units, tep.all_joined_units)  # deprecated
         self.assertIs(tep.relations[0].units, tep.relations[0].joined_units)  # deprecated
 
+    def test_prefetch_received(self):
+        from charms.reactive import endpoints
+        relation_get = endpoints.hookenv.relation_get
+        self.addCleanup(endpoints.install_relation_data_fetcher,
+                        endpoints.relation_data_fetcher())
+
+        # the default fetcher gets each unit's data with relation-get
+        Endpoint._startup()
+        tep = Endpoint.from_name('test-endpoint')
+        self.assertCountEqual([c[1] for c in relation_get.call_args_list], [
+            {'unit': 'unit/0', 'rid': 'test-endpoint:0'},
+            {'unit': 'unit/1', 'rid': 'test-endpoint:0'},
+            {'unit': 'unit/0', 'rid': 'test-endpoint:1'},
+            {'unit': 'unit/1', 'rid': 'test-endpoint:1'},
+        ])
+        self.assertEqual(tep.relations[1].joined_units['unit/1'].received, {'foo': 'no'})
+
+        # one by one, unless more workers are configured
+        units = [('test-endpoint:0', 'unit/0'), ('test-endpoint:1', 'unit/1')]
+        with mock.patch.object(endpoints, 'ThreadPoolExecutor',
+                               wraps=endpoints.ThreadPoolExecutor) as executor:
+            self.assertEqual(endpoints.RelationDataFetcher().workers, 1)
+            endpoints.RelationDataFetcher().fetch(units)
+            assert not executor.called
+            data = endpoints.RelationDataFetcher(workers=4).fetch(units)
+        executor.assert_called_once_with(max_workers=2)
+        self.assertEqual(data[units[1]], {'foo': 'no'})
+
+        fetcher = mock.Mock()
+        fetcher.fetch.side_effect = lambda units: {unit: {'fetched': '"{}"'.format(unit[1])}
+                                                   for unit in units}
+        endpoints.install_relation_data_fetcher(fetcher)
+        relation_get.reset_mock()
+        Endpoint._endpoints.clear()
+        Endpoint._startup()
+        tep = Endpoint.from_name('test-endpoint')
+        fetcher.fetch.assert_called_once_with([
+            ('test-endpoint:0', 'unit/0'),
+            ('test-endpoint:0', 'unit/1'),
+            ('test-endpoint:1', 'unit/0'),
+            ('test-endpoint:1', 'unit/1'),
+        ])
+        assert not relation_get.called
+        self.assertEqual(tep.relations[1].joined_units['unit/1'].received, {'fetched': 'unit/1'})
+
+        # nothing is fetched outside of relation hooks once joined
+        fetcher.fetch.reset_mock()
+        Endpoint._endpoints.clear()
+        self.hook_name = 'update-status'
+        Endpoint._startup()
+        assert not fetcher.fetch.called
+
+    def test_received_digests(self):
+        from charms.reactive.helpers import data_changed
+
+        def _changed_keys():
+            digests = ReceivedDigests('test-endpoint')
+            units = Endpoint('test-endpoint', ['test-endpoint:0', 'test-endpoint:1']).all_joined_units
+            changed = {(unit.relation.relation_id, unit.unit_name): digests.changed_keys(unit)
+                       for unit in units}
+            digests.save()
+            return changed
+
+        # migrated from the keys stored by data_changed for each value
+        data_changed('endpoint.test-endpoint.test-endpoint:0.unit/0.foo', 'yes')
+        data_changed('endpoint.test-endpoint.test-endpoint:1.unit/0.bar', [1, 2])
+        data_changed('endpoint.test-endpoint.test-endpoint:1.unit/1.foo', 'yes')
+        self.assertEqual(_changed_keys(), {
+            ('test-endpoint:0', 'unit/0'): [],
+            ('test-endpoint:0', 'unit/1'): [],
+            ('test-endpoint:1', 'unit/0'): [],
+            ('test-endpoint:1', 'unit/1'): ['foo'],
+        })
+        self.assertEqual(self.kv.getrange('reactive.data_changed.'), {})
+        self.assertEqual(list(self.kv.getrange('reactive.endpoints.digests.')),
+                         ['reactive.endpoints.digests.test-endpoint'])
+
+        self.assertEqual(_changed_keys(), {
+            ('test-endpoint:0', 'unit/0'): [],
+            ('test-endpoint:0', 'unit/1'): [],
+            ('test-endpoint:1', 'unit/0'): [],
+            ('test-endpoint:1', 'unit/1'): [],
+        })
+
+        self.relations['test-endpoint'][0]['unit/1'] = {'foo': 'no', 'bar': 'baz'}
+        self.relations['test-endpoint'][1]['unit/0'] = {'bar': '[1, 2, 3]'}
+        del self.relations['test-endpoint'][1]['unit/1']
+        with mock.patch.object(ReceivedDigests, '_digest', wraps=ReceivedDigests._digest) as digest:
+            self.assertEqual(_changed_keys(), {
+                ('test-endpoint:0', 'unit/0'): [],
+                ('test-endpoint:0', 'unit/1'): ['bar', 'foo'],
+                ('test-endpoint:1', 'unit/0'): ['bar'],
+            })
+        # the values of unchanged units are not hashed
+        self.assertEqual(digest.call_count, 3 + 2 + 1)
+        # the departed unit is forgotten
+        self.assertEqual(sorted(self.kv.get('reactive.endpoints.digests.test-endpoint')['test-endpoint:1']),
+                         ['unit/0'])
+
+        # values are compared once decoded, so reformatting is not a change
+        self.relations['test-endpoint'][1]['unit/0'] = {'bar': '[1,2,3]'}
+        self.assertEqual(_changed_keys(), {
+            ('test-endpoint:0', 'unit/0'): [],
+            ('test-endpoint:0', 'unit/1'): [],
+            ('test-endpoint:1', 'unit/0'): [],
+        })
+
+    def test_manage_flags_remote_unit(self):
+        from charms.reactive import endpoints
+        relation_get = endpoints.hookenv.relation_get
+        Endpoint._startup()
+        digests = self.kv.get('reactive.endpoints.digests.test-endpoint')
+        self.assertCountEqual(digests['test-endpoint:1'], ['unit/0', 'unit/1'])
+
+        # only the data of the remote unit is read and compared
+        for flag in ('changed', 'changed.foo', 'changed.bar'):
+            clear_flag('endpoint.test-endpoint.' + flag)
+        self.relations['test-endpoint'][1]['unit/0'] = {'bar': '[1, 2, 3]'}
+        self.relations['test-endpoint'][1]['unit/1'] = {'foo': 'yes'}
+        self.hook_name = 'test-endpoint-relation-changed'
+        self.relation_id = 'test-endpoint:1'
+        self.remote_unit = 'unit/1'
+        relation_get.reset_mock()
+        Endpoint._endpoints.clear()
+        Endpoint._startup()
+        self.assertEqual([c[1] for c in relation_get.call_args_list],
+                         [{'unit': 'unit/1', 'rid': 'test-endpoint:1'}])
+        assert is_flag_set('endpoint.test-endpoint.changed')
+        assert is_flag_set('endpoint.test-endpoint.changed.foo')
+        assert not is_flag_set('endpoint.test-endpoint.changed.bar')
+        digests = self.kv.get('reactive.endpoints.digests.test-endpoint')
+        self.assertCountEqual(digests['test-endpoint:0'], ['unit/0', 'unit/1'])
+        self.assertCountEqual(digests['test-endpoint:1'], ['unit/0', 'unit/1'])
+
+        # the departing unit is forgotten
+        self.relations['test-endpoint'][1]['unit/1']['departed'] = 'yes'
+        self.hook_name = 'test-endpoint-relation-departed'
+        relation_get.reset_mock()
+        Endpoint._endpoints.clear()
+        Endpoint._startup()
+        # only to keep the departed unit's data
+        self.assertEqual([c[1] for c in relation_get.call_args_list],
+                         [{'unit': 'unit/1', 'rid': 'test-endpoint:1'}])
+        digests = self.kv.get('reactive.endpoints.digests.test-endpoint')
+        self.assertCountEqual(digests['test-endpoint:1'], ['unit/0'])
+
+        # all units are compared on upgrade
+        clear_flag('endpoint.test-endpoint.changed')
+        self.hook_name = 'upgrade-charm'
+        Endpoint._endpoints.clear()
+        Endpoint._startup()
+        assert is_flag_set('endpoint.test-endpoint.changed.bar')
+
     def test_departed(self):
         # clean up some units for this test
         del self.relations['test-endpoint'][0]['unit/1']
@@ -404,6 +573,32 @@ class TestEndpoint(unittest.TestCase):
         with self.assertRaises(ValueError):
             tep.relations[0].joined_units[0].received['foo'] = 'nope'
 
+    def test_receive_decoded_once(self):
+        from charms.reactive.endpoints import JSONUnitDataView
+        remember_received(self.relations)
+        Endpoint._startup()
+        tep = Endpoint.from_name('test-endpoint')
+        unit = tep.relations[1].joined_units['unit/0']
+
+        with mock.patch('charms.reactive.endpoints.json.loads', wraps=json.loads) as loads:
+            self.assertEqual(unit.received['bar'], [1, 2])
+            self.assertIs(unit.received.get('bar'), unit.received['bar'])
+            self.assertIs(tep.all_joined_units.received['bar'],
+                          tep.all_joined_units.received['bar'])
+        self.assertEqual(loads.call_count, 2)
+
+        # the merged view chains the units' data rather than copying it
+        self.assertEqual(dict(tep.all_joined_units.received_raw), {'foo': 'yes', 'bar': '[1, 2]'})
+        self.assertIs(tep.all_joined_units.received_raw.data.maps[2],
+                      tep.relations[1].joined_units['unit/0'].received_raw.data)
+
+        # writeable views decode each time, as their values may be modified
+        view = JSONUnitDataView({'list': '[1]'}, writeable=True)
+        view['list'].append(2)
+        self.assertEqual(view['list'], [1])
+        view['list'] = [1, 2]
+        self.assertEqual(view['list'], [1, 2])
+
     def test_receive_app(self):
         Endpoint._startup()
         tep = Endpoint.from_name('test-endpoint')
@@ -467,6 +662,37 @@ class TestEndpoint(unittest.TestCase):
         assert 'foo' not in rel.to_publish
         assert rel.to_publish['foo'] is None
 
+    def test_to_publish_changes(self):
+        self.relations['test-endpoint'][0]['local/0'] = {'key': 'value', 'blob': '"large"'}
+        Endpoint._startup()
+        tep = Endpoint.from_name('test-endpoint')
+        rel = tep.relations[0]
+
+        # set back to the original values
+        rel.to_publish['blob'] = 'changed'
+        rel.to_publish['blob'] = 'large'
+        rel.to_publish_raw['new'] = None
+        assert rel.to_publish.modified
+        self.assertEqual(rel.to_publish_raw.changes, {})
+        rel._flush_data()
+        assert not self.relation_set.called
+
+        # only the changed values are published
+        rel.to_publish['blob'] = 'large'
+        rel.to_publish_raw['key'] = 'new-value'
+        rel.to_publish['new'] = [1]
+        rel._flush_data()
+        self.relation_set.assert_called_once_with('test-endpoint:0', {'key': 'new-value',
+                                                                      'new': '[1]'})
+
+        # and only once
+        self.relation_set.reset_mock()
+        rel._flush_data()
+        assert not self.relation_set.called
+        rel.to_publish['new'] = [1, 2]
+        rel._flush_data()
+        self.relation_set.assert_called_once_with('test-endpoint:0', {'new': '[1, 2]'})
+
     def test_to_publish_app(self):
         Endpoint._startup()
         tep = Endpoint.from_name('test-endpoint')
@@ -509,11 +735,11 @@ class TestEndpoint(unittest.TestCase):
                              if hasattr(h, '_action') and
                              h._action.__qualname__.startswith('TestAltRequires.')}
         assert Handler._HANDLERS
-        preds = [h._predicates[0].args[0][0] for h in Handler.get_handlers()]
+        preds = [h.conditions[0].flags[0] for h in Handler.get_handlers()]
         for pred in preds:
             self.assertRegex(pred, r'^endpoint.test-endpoint.')
 
-        self.data_changed.return_value = False
+        remember_received(self.relations)
         Endpoint._startup()
         tep = Endpoint.from_name('test-endpoint')
 
@@ -530,7 +756,7 @@ class TestEndpoint(unittest.TestCase):
         clear_flag('endpoint.test-endpoint2.joined')
         clear_flag('endpoint.test-endpoint2.changed')
         clear_flag('endpoint.test-endpoint2.changed.foo')
-        self.data_changed.return_value = True
+        forget_received()
         Endpoint._startup()
         dispatch()
         self.assertCountEqual(tep.invocations, [
@@ -556,6 +782,7 @@ class TestEndpoint(unittest.TestCase):
                 'unit/1': {'foo': 'no'},
             },
         ]
+        forget_received()
         Endpoint._startup()
         dispatch()
         self.assertCountEqual(tep.invocations, [
@@ -646,9 +873,6 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
         self.rel_set_p = mock.patch('charmhelpers.core.hookenv.relation_set')
         self.relation_set = self.rel_set_p.start()
 
-        self.data_changed_p = mock.patch('charms.reactive.endpoints.data_changed')
-        self.data_changed = self.data_changed_p.start()
-
         self.atexit_p = mock.patch('charmhelpers.core.hookenv.atexit')
         self.atexit = self.atexit_p.start()
 
@@ -667,7 +891,6 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
         self.rel_units_p.stop()
         self.rel_get_p.stop()
         self.rel_set_p.stop()
-        self.data_changed_p.stop()
         self.atexit_p.stop()
         self.test_db.unlink()
         self.sysm_p.stop()
@@ -706,7 +929,6 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
             register_trigger(when=joined_flag, set_flag=alias_joined_flag)
             register_trigger(when_not=joined_flag, clear_flag=alias_joined_flag)
 
-        self.data_changed.return_value = True
         with mock.patch.object(Endpoint, 'register_triggers',
                                _register_triggers):
             Endpoint._startup()
@@ -728,19 +950,20 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
 
         # relation hook
         self.hook_name = 'test-endpoint-relation-joined'
+        forget_received()
         clear_flag('endpoint.test-endpoint.changed')
         Endpoint._startup()
         assert is_flag_set('endpoint.test-endpoint.changed')
 
         # not already joined
         self.hook_name = 'upgrade-charm'
+        forget_received()
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
         Endpoint._startup()
         assert is_flag_set('endpoint.test-endpoint.changed')
 
         # data not changed
-        self.data_changed.return_value = False
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
         Endpoint._startup()
@@ -896,11 +1119,11 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
                              if hasattr(h, '_action') and
                              h._action.__qualname__.startswith('TestAltRequires.')}
         assert Handler._HANDLERS
-        preds = [h._predicates[0].args[0][0] for h in Handler.get_handlers()]
+        preds = [h.conditions[0].flags[0] for h in Handler.get_handlers()]
         for pred in preds:
             self.assertRegex(pred, r'^endpoint.test-endpoint.')
 
-        self.data_changed.return_value = False
+        remember_received(self.relations)
         Endpoint._startup()
         tep = Endpoint.from_name('test-endpoint')
 
@@ -913,7 +1136,7 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
         tep.invocations.clear()
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
-        self.data_changed.return_value = True
+        forget_received()
         Endpoint._startup()
         dispatch()
         self.assertCountEqual(tep.invocations, [
@@ -924,6 +1147,7 @@ class TestEndpointOneUnitPeer(unittest.TestCase):
         tep.invocations.clear()
         clear_flag('endpoint.test-endpoint.joined')
         clear_flag('endpoint.test-endpoint.changed')
+        forget_received()
         Endpoint._startup()
         dispatch()
         self.assertCountEqual(tep.invocations, [
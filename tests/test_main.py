@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib
+import subprocess
+import sys
 import unittest
 
 import mock
@@ -66,3 +69,42 @@ class TestReactiveRestrictedMain(unittest.TestCase):
         discover.side_effect = SystemExit(1)
         self.assertRaises(SystemExit, reactive.main)
         assert not _KV.flush.called
+
+
+class TestLazyExports(unittest.TestCase):
+    def test_exports(self):
+        self.assertIs(reactive.when, reactive.decorators.when)
+        self.assertIs(reactive.set_flag, reactive.flags.set_flag)
+        self.assertIs(reactive.Endpoint, reactive.endpoints.Endpoint)
+        self.assertIn('when_not', dir(reactive))
+        self.assertRaises(AttributeError, getattr, reactive, 'no_such_name')
+
+    def test_deprecated_names(self):
+        self.assertIs(reactive.bus.set_state, reactive.flags.set_flag)
+        self.assertIs(reactive.bus.StateList, reactive.flags.StateList)
+        self.assertIs(reactive.helpers.is_state, reactive.flags.is_flag_set)
+        self.assertIs(reactive.helpers.toggle_state, reactive.flags.toggle_flag)
+        self.assertRaises(AttributeError, getattr, reactive.bus, 'no_such_name')
+
+    def test_lazy_import(self):
+        script = ('import sys, charms.reactive.bus; '
+                  'print(sorted(m for m in sys.modules if m.startswith("charms.reactive")))')
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+        self.assertEqual(output.strip(), "['charms.reactive', 'charms.reactive.bus', 'charms.reactive.trace']")
+
+    def test_star_import(self):
+        script = ('from charms.reactive import *; '
+                  'print(when is decorators.when, set_flag is flags.set_flag, '
+                  'Endpoint is endpoints.Endpoint, RelationBase is relations.RelationBase, '
+                  'callable(main))')
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+        self.assertEqual(output.strip(), 'True True True True True')
+
+    def test_all(self):
+        # every name exported by the modules is listed, and can be resolved
+        exported = set(reactive.__all__)
+        for module_name in reactive._EXPORT_MODULES:
+            module = importlib.import_module(module_name, 'charms.reactive')
+            self.assertLessEqual(set(module.__all__), exported, module_name)
+        for name in reactive.__all__:
+            self.assertIsNotNone(getattr(reactive, name), name)
@@ -15,12 +15,15 @@
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
 import sys
+import tempfile
 import types
 import mock
 import unittest
 
 from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
 from charms.reactive import relations
 
 
@@ -46,14 +49,15 @@ class TestFactory(unittest.TestCase):
         ])
         log.assert_called_once_with(mock.ANY, relations.hookenv.ERROR)
 
-    @mock.patch.object(relations, 'iter_entry_points')
+    @mock.patch.object(relations.EntryPointCache, 'load')
+    @mock.patch.object(relations.EntryPointCache, 'get')
     @mock.patch.object(relations, '_find_relation_factory')
     @mock.patch.object(relations.hookenv, 'log')
     @mock.patch.object(relations, '_relation_module')
     @mock.patch.object(relations.hookenv, 'charm_dir')
     @mock.patch.object(relations.hookenv, 'relation_to_role_and_interface')
     def test_relation_factory(self, relation_to_role_and_interface, charm_dir,
-                              rel_mod, log, find_factory, iter_entry_points):
+                              rel_mod, log, find_factory, get_eps, load_ep):
         relation_to_role_and_interface.return_value = ('role', 'interface')
         charm_dir.return_value = 'charm_dir'
         rel_mod.return_value = 'module'
@@ -67,8 +71,11 @@ class TestFactory(unittest.TestCase):
 
             load = mock.Mock()
 
-        iter_entry_points.return_value = [mock.Mock(load=lambda: MockRelFactory)]
+        get_eps.return_value = [('mock', 'mock_module:MockRelFactory')]
+        load_ep.return_value = MockRelFactory
         relations.RelationFactory.discover()
+        get_eps.assert_called_once_with('charms.reactive.relation_factory')
+        load_ep.assert_called_once_with(('mock', 'mock_module:MockRelFactory'))
         assert MockRelFactory.load.called
 
         self.assertEqual(relations.relation_factory('relname'), 'fact')
@@ -77,6 +84,45 @@ class TestFactory(unittest.TestCase):
         find_factory.assert_called_once_with('module')
         self.assertIs(relations.RelationFactory.get_factory('foo'), MockRelFactory)
 
+    @mock.patch.object(relations, 'importlib_metadata')
+    @mock.patch.object(relations.hookenv, 'charm_dir')
+    def test_entry_point_cache(self, charm_dir, importlib_metadata):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        charm_dir.return_value = tmpdir
+        kv = unitdata.Storage(os.path.join(tmpdir, 'unit-state.db'))
+        self.addCleanup(kv.close)
+        ep = mock.Mock(value='os.path:join')
+        ep.name = 'join'
+        eps = importlib_metadata.entry_points.return_value
+        eps.select.return_value = [ep]
+        site_dir = os.path.join(tmpdir, '..', os.path.basename(tmpdir) + '-site')
+        os.mkdir(site_dir)
+        self.addCleanup(os.rmdir, site_dir)
+
+        with mock.patch.object(unitdata, '_KV', kv), \
+                mock.patch.object(sys, 'path', [tmpdir, site_dir]):
+            cache = relations.EntryPointCache
+            self.assertEqual(cache.get('group'), [('join', 'os.path:join')])
+            eps.select.assert_called_once_with(group='group')
+            # the charm dir is not part of the fingerprint
+            self.assertEqual(cache.fingerprint(),
+                             [[os.path.abspath(site_dir), os.stat(site_dir).st_mtime_ns]])
+
+            # cached while the site dirs are unchanged
+            self.assertEqual(cache.get('group'), [('join', 'os.path:join')])
+            self.assertEqual(eps.select.call_count, 1)
+
+            # rescanned when a package is installed
+            os.utime(site_dir, ns=(0, 0))
+            eps.select.return_value = []
+            self.assertEqual(cache.get('group'), [])
+            self.assertEqual(eps.select.call_count, 2)
+
+        self.assertIs(cache.load(('join', 'os.path:join')), os.path.join)
+        self.assertIs(cache.load(('path', 'os.path')), os.path)
+        self.assertIs(cache.load(('sep', 'os.path : sep [extra]')), os.path.sep)
+
     def test_find_relation_factory(self):
         mod = types.ModuleType('mod')
         mod.__name__ = 'here'
@@ -15,6 +15,9 @@
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
 from textwrap import dedent
+import json
+import os
+import tempfile
 import unittest
 from unittest import mock
 
@@ -31,35 +34,156 @@ class TestTracer(unittest.TestCase):
     def test_logtracer_api(self, log, gh, sid):
         sid.side_effect = lambda x, y: x
         h = reactive.bus.Handler
-        gh.side_effect = [
-            [h('handler_1')],
-            [h('handler_2'), h('handler_3')],
-        ]
-        self._test_api(reactive.trace.LogTracer())
+        handlers = [h('handler_1'), h('handler_2'), h('handler_3'), h('handler_4')]
+        handlers[0].register_flags(['flag_a'])
+        handlers[1].register_flags(['flag_b'])
+        handlers[2].register_flags(['flag_b'])
+        gh.return_value = handlers
+        queued = {'handler_1', 'handler_3', 'handler_4'}
+        with mock.patch.object(h, 'test', autospec=True) as test:
+            test.side_effect = lambda handler: handler._action in queued
+            self._test_api(reactive.trace.LogTracer(), active=[handlers[1]])
+        # only handlers watching the changed flags are re-tested
+        self.assertEqual([c[0][0] for c in test.call_args_list],
+                         [handlers[0], handlers[1], handlers[2]])
         # We are not wedded to this format. We should change it if we
         # can come up with something more generally readable. Multiline
         # strings are used to avoid hookenv.log call overhead (juju-log is
-        # expensive), but that might be premature optimization.
-        log.assert_has_calls([
+        # expensive), and the messages of each iteration are emitted at once.
+        self.assertEqual(log.call_args_list, [
             mock.call('tracer: starting handler dispatch, 0 flags set', 'DEBUG'),
             mock.call('tracer: hooks phase, 0 handlers queued', 'DEBUG'),
             mock.call(dedent('''\
                       tracer>
                       tracer: set flag flag_a
                       tracer: ++   queue handler handler_1
-                      ''').strip(), 'DEBUG'),
-            mock.call(dedent('''\
-                      tracer>
                       tracer: cleared flag flag_b
-                      tracer: ++   queue handler handler_2
                       tracer: ++   queue handler handler_3
-                      tracer: -- dequeue handler handler_1
+                      tracer: -- dequeue handler handler_2
                       ''').strip(), 'DEBUG'),
         ])
 
-    def _test_api(self, imp):
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    def test_profilingtracer_api(self, atexit, hook_name):
+        hook_name.return_value = 'config-changed'
+        handler = mock.Mock(name='handler')
+        handler.id.return_value = 'handler_1'
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        imp = reactive.trace.ProfilingTracer(path)
+        self._test_api(imp, handler)
+        atexit.assert_called_once_with(imp.report)
+        imp.report()
+        with open(path) as f:
+            report = json.loads(f.read())
+        self.assertEqual(report['hook'], 'config-changed')
+        self.assertGreaterEqual(report['elapsed'], 0)
+        stats = report['handlers']['handler_1']
+        self.assertEqual(stats['test_calls'], 1)
+        self.assertEqual(stats['invoke_calls'], 1)
+        self.assertEqual(stats['external_test_calls'], 1)
+        self.assertEqual(stats['external_invoke_calls'], 1)
+        self.assertEqual(stats['iterations'], 1)
+        self.assertGreaterEqual(stats['invoke_time'], stats['external_invoke_time'])
+        self.assertEqual(report['endpoints']['endpoint_a']['startup_calls'], 1)
+
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.log')
+    def test_profilingtracer_log(self, log, atexit, hook_name):
+        hook_name.return_value = 'install'
+        imp = reactive.trace.ProfilingTracer()
+        imp.start_dispatch()
+        imp.report()
+        msg, level = log.call_args[0]
+        self.assertEqual(level, 'DEBUG')
+        self.assertTrue(msg.startswith('tracer: profile '))
+        self.assertEqual(json.loads(msg[len('tracer: profile '):])['handlers'], {})
+
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    @mock.patch('charmhelpers.core.hookenv._atstart', new_callable=list)
+    def test_startup_profiler(self, atstart, hook_name, charm_dir):
+        profiler = reactive.trace.StartupProfiler
+        self.addCleanup(profiler.disable)
+        hook_name.return_value = 'install'
+        charm_dir.return_value = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, charm_dir.return_value)
+        path = os.path.join(charm_dir.return_value, 'profile.json')
+        self.addCleanup(os.remove, path)
+
+        # disabled, nothing is recorded or wrapped
+        profiler.disable()
+        callback = mock.Mock(__module__='mod', __qualname__='callback')
+        atstart.append((callback, ('a',), {}))
+        with profiler.measure('discover'):
+            profiler.wrap_atstart()
+        self.assertIs(atstart[0][0], callback)
+        profiler.report()
+        self.assertFalse(os.path.exists(path))
+
+        profiler.enable()
+        with profiler.measure('discover'):
+            with profiler.measure('discover', 'reactive.mod'):
+                pass
+        profiler.start('endpoints', 'endpoint_a')
+        profiler.stop('endpoints', 'endpoint_a')
+        profiler.record('import', 'charms.reactive', 2)
+        with profiler.measure('atstart'):
+            profiler.wrap_atstart()
+            for cb, args, kwargs in atstart:
+                cb(*args, **kwargs)
+        callback.assert_called_once_with('a')
+
+        with mock.patch.dict(os.environ, {profiler.ENV: 'profile.json'}):
+            profiler.report()
+            profiler.report()
+        with open(path) as fp:
+            reports = [json.loads(line) for line in fp]
+        self.assertEqual(len(reports), 2)
+        phases = reports[0]['phases']
+        self.assertEqual(reports[0]['hook'], 'install')
+        self.assertEqual(sorted(phases), ['atstart', 'discover', 'endpoints', 'import'])
+        self.assertEqual(phases['import'], {'total': 2, 'items': {'charms.reactive': 2}})
+        self.assertEqual(list(phases['discover']['items']), ['reactive.mod'])
+        self.assertGreaterEqual(phases['discover']['total'],
+                                phases['discover']['items']['reactive.mod'])
+        self.assertEqual(list(phases['endpoints']['items']), ['endpoint_a'])
+        self.assertEqual(list(phases['atstart']['items']), ['mod.callback'])
+        # the timings are reset after each report
+        self.assertEqual(reports[1]['phases'], {})
+
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_startup_profiler_path(self, charm_dir):
+        profiler = reactive.trace.StartupProfiler
+        charm_dir.return_value = '/charm'
+        with mock.patch.dict(os.environ, {profiler.ENV: 'profile.json'}):
+            self.assertEqual(profiler.path(), '/charm/profile.json')
+        with mock.patch.dict(os.environ, {profiler.ENV: '/tmp/profile.json'}):
+            self.assertEqual(profiler.path(), '/tmp/profile.json')
+        with mock.patch.dict(os.environ, {profiler.ENV: 'true'}):
+            os.environ.pop('UNIT_STATE_DB', None)
+            self.assertEqual(profiler.path(), '/charm/reactive-startup-profile.json')
+            os.environ['UNIT_STATE_DB'] = '/var/lib/unit/state.db'
+            self.assertEqual(profiler.path(), '/var/lib/unit/reactive-startup-profile.json')
+
+    def _test_api(self, imp, handler=None, active=()):
+        handler = handler or mock.Mock(name='handler')
+        imp.start_endpoint_startup('endpoint_a')
+        imp.end_endpoint_startup('endpoint_a')
         imp.start_dispatch()
         imp.start_dispatch_phase('hooks', [])
-        imp.start_dispatch_iteration(0, [])
+        imp.start_dispatch_iteration(0, list(active))
+        imp.start_handler_test(handler)
+        imp.start_external_call(handler, 'test')
+        imp.end_external_call(handler, 'test')
+        imp.end_handler_test(handler, True)
+        imp.start_handler_invoke(handler)
+        imp.start_external_call(handler, 'invoke')
+        imp.end_external_call(handler, 'invoke')
+        imp.end_handler_invoke(handler)
         imp.set_flag('flag_a')
         imp.clear_flag('flag_b')
+        imp.end_dispatch()